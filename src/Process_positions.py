@@ -13,6 +13,7 @@ import matplotlib
 matplotlib.use('TkAgg')
 
 import json
+import time
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -73,7 +74,9 @@ def flip_y_axis_rotation(Matrix):
 def load_valid_marker_data(marker_detections):
     """
     loads marker positions and rvecs/tvecs from a JSON file.
-    Filters out invalid entries.
+    Filters out invalid entries and entries below params.QUALITY_THRESHOLD, sorts the detections of every camera by rank:
+    the quality times the expected pixel area of the marker at its distance (up to params.QUALITY_FULL_AREA),
+    so near markers are preferred without dropping distant ones.
     Args:
         path (str): Path to the JSON file containing marker positions and rvecs/tvecs.
     Returns:
@@ -88,14 +91,22 @@ def load_valid_marker_data(marker_detections):
                 detected_id = int(other['detected_id'])
                 rvec = other['Position'][0]['rvecs']
                 tvec = other['Position'][1]['tvecs']
-                if len(rvec) == 3 and len(tvec) == 3:
+                # peers without quality gating publish no score, treat them as neutral
+                quality = float(other.get('quality', 1.0))
+                if len(rvec) == 3 and len(tvec) == 3 and quality >= params.QUALITY_THRESHOLD:
+                    distance = max(float(tvec[2]), 1e-6)
+                    expected_area = params.CAMERA_MATRIX[0, 0] * params.CAMERA_MATRIX[1, 1] * (params.MARKERLENGTH / distance) ** 2
                     valid_detections.append({
                         'detected_id': detected_id,
                         'rvec': rvec,
-                        'tvec': tvec
+                        'tvec': tvec,
+                        'quality': quality,
+                        'rank': quality * min(1.0, expected_area / params.QUALITY_FULL_AREA)
                     })
             except (ValueError, KeyError, IndexError, TypeError):
                 continue
+        # best detection first, the solver uses the first usable edge of every camera pair
+        valid_detections.sort(key=lambda detection: detection['rank'], reverse=True)
         camera_views[cam_id] = valid_detections
     return camera_views
 
@@ -140,6 +151,23 @@ def rvec_tvec_to_matrix(rvec, tvec):
     T[:3, 3] = np.array(tvec).reshape(3)
     return T
 
+def solve_anchor_camera(anchor_detection):
+    """
+    Computes the global pose of the camera that sees a marker of the global origin cube.
+    Args:
+        anchor_detection (dict): Detection entry of an anchor marker with 'detected_id', 'rvec' and 'tvec'.
+    Returns:
+        Transformer_matrix_global_to_cam (np.ndarray): global 4x4 transformation matrix of the anchor camera.
+    """
+    anchor_marker_id = anchor_detection['detected_id']
+
+    Transformer_matrix_marker_to_cam = rvec_tvec_to_matrix(anchor_detection['rvec'], anchor_detection['tvec']) # Marker (an neuer Kamera) aus Sicht bekannter Kamera
+    Transformer_matrix_global_to_cam = Transformer_matrix_marker_to_cam @ params.ANCHOR_MARKER_WORLD_POSES[anchor_marker_id]
+    Transformer_matrix_global_to_cam = np.linalg.inv(Transformer_matrix_global_to_cam)
+
+    Transformer_matrix_global_to_cam[0, 3] *= -1
+    return Transformer_matrix_global_to_cam
+
 def try_solve_cameras_from_solved(camera_views, solved_cameras):
     """ 
     Tries to solve cameras with known cameras.
@@ -191,28 +219,67 @@ def try_solve_cameras_from_unsolved(camera_views, solved_cameras):
                 continue
     return solved_cameras
 
+def align_camera_views(camera_views, pose_history, max_age_seconds=params.POSE_HISTORY_MAX_AGE_SECONDS):
+    """
+    Replaces the latest poses in camera_views by the poses from the pose history at one common reference time.
+    The reference time is the oldest of the newest timestamps of all recent edges, so no edge has to be extrapolated.
+    Edges older than max_age_seconds (e.g. of a peer that went offline) do not set the reference time,
+    otherwise one dead peer would hold all live edges in the past. Edges whose history does not reach
+    back to the reference time keep their latest pose.
+    Args:
+        camera_views (dict): Mapping of all spotted markers in addition to all camera perspectives.
+        pose_history (PoseHistory): Time indexed poses of all (camera, marker) pairs.
+        max_age_seconds (float): Maximum age of an edge to be considered for the reference time.
+    Returns:
+        camera_views (dict): camera_views with the interpolated rvecs and tvecs.
+        reference_time (float): Common reference time in seconds, None if no recent edge is in the history.
+    """
+    oldest_allowed = time.time() - max_age_seconds
+    latest_times = []
+    for cam_id, detections in camera_views.items():
+        for detection in detections:
+            latest_time = pose_history.latest_time(cam_id, detection['detected_id'])
+            if latest_time is not None and latest_time >= oldest_allowed:
+                latest_times.append(latest_time)
+    if not latest_times:
+        return camera_views, None
+
+    reference_time = min(latest_times)
+    for cam_id, detections in camera_views.items():
+        for detection in detections:
+            rvec, tvec = pose_history.pose_at(cam_id, detection['detected_id'], reference_time)
+            if rvec is not None:
+                detection['rvec'] = rvec
+                detection['tvec'] = tvec
+    return camera_views, reference_time
+
 #--------------------------------------------------------------------------------#
 # Main program
 #--------------------------------------------------------------------------------#
 
-def process_positions(marker_detections):
+def process_positions(marker_detections, pose_history=None):
     """
     Main function for processing camera positions and marker detections.
     Called from main.py.
 
     Performs the following steps:
-    1. Loads camera data from marker_positions_rvecs_tvecs
+    1. Loads camera data from marker_positions_rvecs_tvecs, aligned to a common time if pose_history is given
     2. Finds the anchor camera that sees a zero-point marker
     3. Computes the global pose of the anchor camera and updates solved_cameras
     4. Iterates over all cameras and computes their global poses
     5. Creates a DataFrame with all camera positions and their viewing directions
 
+    Args:
+        marker_detections (list): marker_positions with the latest detections of all cameras.
+        pose_history (PoseHistory, optional): Pose history to align all detections to a common reference time.
     Returns:
         global_camera_poses_positions (pd.DataFrame): DataFrame with columns ['id', 'x', 'z', 'dir_x', 'dir_z', 'angle_rad', 'angle_deg']."""
     try:
         
         # 1. load data
         camera_views = load_valid_marker_data(marker_detections)
+        if pose_history is not None:
+            camera_views, _ = align_camera_views(camera_views, pose_history)
         #print("camera_views:\n", camera_views)
 
         # 2. get anchor camera, prefered camera is params.CAMERA_ID, else the first camera that sees an anchor marker
@@ -222,13 +289,7 @@ def process_positions(marker_detections):
             exit(1)
 
         # 3. process Transformation Matrix from global to camera, update solved cameras
-        anchor_marker_id = anchor_detection['detected_id']
-
-        Transformer_matrix_marker_to_cam = rvec_tvec_to_matrix(anchor_detection['rvec'], anchor_detection['tvec']) # Marker (an neuer Kamera) aus Sicht bekannter Kamera
-        Transformer_matrix_global_to_cam = Transformer_matrix_marker_to_cam @ params.ANCHOR_MARKER_WORLD_POSES[anchor_marker_id]
-        Transformer_matrix_global_to_cam = np.linalg.inv(Transformer_matrix_global_to_cam)
-
-        Transformer_matrix_global_to_cam[0, 3] *= -1
+        Transformer_matrix_global_to_cam = solve_anchor_camera(anchor_detection)
 
         solved_cameras = {anchor_cam_id: Transformer_matrix_global_to_cam}
 
@@ -0,0 +1,263 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Offline batch processing of recorded videos and image folders.
+The frames of all inputs are split into chunks of consecutive frames, which are processed by a process pool.
+Every worker creates one ArucoDetector and reuses it for all of its frames.
+Seeking in compressed videos is not always frame accurate and the frame count of a video is only an estimate,
+so the seek position is checked (with sequential decoding as fallback) and the last chunk reads to the end of the video.
+For every frame the detections (id, rvec, tvec, quality) and the global pose of the recording camera
+(if it sees the origin cube) are written to columnar output, chunk by chunk as the results arrive:
+- <output>/detections.npy, <output>/frames.npy: structured NumPy arrays in .npy files
+- or <output>/detections.csv, <output>/frames.csv with --csv
+
+Usage:
+    python batch_process.py ../recordings/run1.mp4 ../recordings/images --output ../results --workers 8
+"""
+
+import os
+import csv
+import time
+import struct
+import argparse
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import params as params
+from utils import get_aruco_markers
+from process_positions import load_valid_marker_data, find_anchor_camera, solve_anchor_camera
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+DETECTION_DTYPE = np.dtype([
+    ('source', np.int16), ('frame', np.int32), ('detected_id', np.int16),
+    ('rvec', np.float64, 3), ('tvec', np.float64, 3), ('quality', np.float32)
+])
+FRAME_DTYPE = np.dtype([
+    ('source', np.int16), ('frame', np.int32), ('detections', np.int16),
+    ('solved', np.bool_), ('x', np.float64), ('z', np.float64), ('angle_deg', np.float64)
+])
+
+# persistent detector of the worker process, created once by init_worker
+worker_detector = None
+
+def init_worker():
+    global worker_detector
+    # one thread per process, the pool provides the parallelism
+    cv2.setNumThreads(1)
+    worker_detector = aruco.ArucoDetector(params.aruco_dict, params.parameters)
+
+def list_sources(paths):
+    """
+    Expands the inputs into sources with their frame count.
+    Args:
+        paths (list): Video files or image folders.
+    Returns:
+        sources (list): List of (path, frame_count, image_files or None).
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            images = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+            sources.append((path, len(images), [os.path.join(path, name) for name in images]))
+        else:
+            cap = cv2.VideoCapture(path)
+            if not cap.isOpened():
+                print(f"Error: Cannot open {path}")
+                continue
+            sources.append((path, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), None))
+            cap.release()
+    return sources
+
+def build_chunks(sources, chunk_size):
+    """
+    Splits all sources into chunks of consecutive frames.
+    The last chunk of a video has no end (None) and reads until the video ends, the frame count is only an estimate.
+    Returns:
+        chunks (list): List of (source_index, path, first_frame, last_frame (exclusive) or None, image_files).
+    """
+    chunks = []
+    for source_index, (path, frame_count, images) in enumerate(sources):
+        for first in range(0, max(frame_count, 1), chunk_size):
+            last = min(first + chunk_size, frame_count)
+            if images is not None:
+                chunks.append((source_index, path, first, last, images[first:last]))
+            else:
+                chunks.append((source_index, path, first, last if last < frame_count else None, None))
+    return chunks
+
+def open_video_at(path, first):
+    """
+    Opens a video positioned at frame first. Seeking jumps to keyframes in many compressed videos,
+    so the position is checked after the seek, if it is wrong the frames before are decoded sequentially.
+    Returns:
+        cap (cv2.VideoCapture) or None if the video ends before frame first.
+    """
+    cap = cv2.VideoCapture(path)
+    if first == 0:
+        return cap
+    if cap.set(cv2.CAP_PROP_POS_FRAMES, first) and int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == first:
+        return cap
+    cap.release()
+    cap = cv2.VideoCapture(path)
+    for _ in range(first):
+        if not cap.grab():
+            cap.release()
+            return None
+    return cap
+
+def read_frames(path, first, last, images):
+    """
+    Yields (frame_index, frame) of one chunk. Videos are opened once per chunk and read sequentially,
+    a chunk without end (last is None) reads until the video ends.
+    """
+    if images is not None:
+        for offset, image_path in enumerate(images):
+            yield first + offset, cv2.imread(image_path)
+        return
+    cap = open_video_at(path, first)
+    if cap is None:
+        return
+    frame_index = first
+    while last is None or frame_index < last:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame_index, frame
+        frame_index += 1
+    cap.release()
+
+def get_camera_pose(ids, rvecs, tvecs, qualities):
+    """
+    Computes the global pose of the recording camera if it sees the origin cube.
+    The qualities are passed on, so the anchor is gated by params.QUALITY_THRESHOLD like at runtime.
+    Returns:
+        tuple (solved (bool), x, z, angle_deg)
+    """
+    others = [{'detected_id': int(i), 'Position': [{'rvecs': r}, {'tvecs': t}], 'quality': float(q)}
+              for i, r, t, q in zip(ids, rvecs, tvecs, qualities)]
+    camera_views = load_valid_marker_data([{'id': params.CAMERA_ID, 'Others': others, 'time': ""}])
+    anchor_cam_id, anchor_detection = find_anchor_camera(camera_views, params.CAMERA_ID, params.ANCHOR_MARKER_IDS)
+    if anchor_cam_id is None:
+        return False, np.nan, np.nan, np.nan
+    T = solve_anchor_camera(anchor_detection)
+    # same viewing direction as build_camera_pose_dataframe
+    return True, T[0, 3], T[2, 3], np.degrees(np.arctan2(-T[0, 2], T[2, 2]))
+
+def process_chunk(chunk):
+    """
+    Processes one chunk in a worker process.
+    Returns:
+        tuple (detections (np.ndarray), frames (np.ndarray)) with DETECTION_DTYPE and FRAME_DTYPE.
+    """
+    source_index, path, first, last, images = chunk
+    detections, frames = [], []
+    for frame_index, frame in read_frames(path, first, last, images):
+        if frame is None:
+            continue
+        ids, rvecs, tvecs, qualities = get_aruco_markers(frame, detector=worker_detector)
+        for detected_id, rvec, tvec, quality in zip(ids, rvecs, tvecs, qualities):
+            detections.append((source_index, frame_index, detected_id, rvec, tvec, quality))
+        frames.append((source_index, frame_index, len(ids)) + get_camera_pose(ids, rvecs, tvecs, qualities))
+    return np.array(detections, dtype=DETECTION_DTYPE), np.array(frames, dtype=FRAME_DTYPE)
+
+class OutputWriter():
+    """
+    Writes chunk results to a .npy or CSV file as they arrive, so the memory use does not grow with the input.
+    The .npy header reserves space for the largest row count and gets the final count in close().
+
+    Methods:
+        write(): Appends the rows of one chunk.
+        close(): Finishes the file.
+    """
+    def __init__(self, path, dtype, as_csv=False):
+        self.dtype = dtype
+        self.as_csv = as_csv
+        self.rows = 0
+        if as_csv:
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            header = []
+            for name in dtype.names:
+                shape = dtype[name].shape
+                header += [f"{name}_{i}" for i in range(shape[0])] if shape else [name]
+            self.writer.writerow(header)
+        else:
+            self.file = open(path, 'wb')
+            # the header length must not change when the real row count is written
+            self.header_size = len(self.npy_header(2 ** 63 - 1, 0))
+            self.file.write(self.npy_header(0, self.header_size))
+
+    def npy_header(self, rows, size):
+        """
+        Returns the .npy (version 1.0) header for rows rows, padded with spaces to size bytes (0: minimal, 64 aligned).
+        """
+        text = repr({'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': (rows,)})
+        # magic string (6) + version (2) + header length (2) + header text ending with a newline
+        if not size:
+            size = -(-(10 + len(text) + 1) // 64) * 64
+        text = text.ljust(size - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(text)) + text.encode('latin1')
+
+    def write(self, result):
+        self.rows += len(result)
+        if not self.as_csv:
+            self.file.write(result.astype(self.dtype, copy=False).tobytes())
+            return
+        for row in result:
+            values = []
+            for name in self.dtype.names:
+                values += row[name].tolist() if self.dtype[name].shape else [row[name].item()]
+            self.writer.writerow(values)
+
+    def close(self):
+        if not self.as_csv:
+            self.file.seek(0)
+            self.file.write(self.npy_header(self.rows, self.header_size))
+        self.file.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect markers and camera poses in recorded videos and image folders.")
+    parser.add_argument('inputs', nargs='+', help="video files or image folders")
+    parser.add_argument('--output', default='batch_output', help="output folder")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--chunk-size', type=int, default=200, help="frames per chunk")
+    parser.add_argument('--csv', action='store_true', help="write CSV instead of .npy")
+    args = parser.parse_args()
+
+    sources = list_sources(args.inputs)
+    chunks = build_chunks(sources, args.chunk_size)
+    total_frames = sum(frame_count for _, frame_count, _ in sources)
+    print(f"{len(sources)} sources, {total_frames} frames, {len(chunks)} chunks, {args.workers} workers")
+
+    os.makedirs(args.output, exist_ok=True)
+    extension = 'csv' if args.csv else 'npy'
+    detection_writer = OutputWriter(os.path.join(args.output, f"detections.{extension}"), DETECTION_DTYPE, args.csv)
+    frame_writer = OutputWriter(os.path.join(args.output, f"frames.{extension}"), FRAME_DTYPE, args.csv)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker) as pool:
+        # map keeps the chunk order, so the output is sorted by source and frame
+        for chunk_detections, chunk_frames in pool.map(process_chunk, chunks):
+            detection_writer.write(chunk_detections)
+            frame_writer.write(chunk_frames)
+    detection_writer.close()
+    frame_writer.close()
+    duration = time.perf_counter() - start
+    processed = frame_writer.rows
+    print(f"Processed {processed} frames in {duration:.1f} s ({processed / max(duration, 1e-9):.1f} frames/s)")
+
+    if not processed:
+        print("Error: no frames processed")
+    with open(os.path.join(args.output, 'sources.txt'), 'w') as f:
+        for source_index, (path, frame_count, _) in enumerate(sources):
+            f.write(f"{source_index}\t{path}\t{frame_count}\n")
+    print(f"Wrote results to {args.output}")
+
+if __name__ == "__main__":
+    main()
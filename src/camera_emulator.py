@@ -0,0 +1,260 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Local emulator for a fleet of ESP32 cameras (CameraWebServer) for load testing without the physical boards.
+Every emulated camera mimics the two HTTP servers of app_httpd.cpp:
+- capture server with /capture: single JPEG with X-Timestamp header (capture_handler)
+- stream server with /stream: chunked multipart JPEG stream, each part with Content-Length and X-Timestamp (stream_handler)
+
+On the ESP32 the servers listen on port 80 and 81. Here camera i listens on
+    capture: BASE_PORT + 2*i, stream: BASE_PORT + 2*i + 1
+so dozens of cameras run in one asyncio process on one machine.
+
+Frames are rendered once (synthetic markers from tune_detector.py) or loaded from recordings,
+resized and JPEG encoded up front, so serving a frame costs only the socket write.
+Jitter and disconnects are simulated per camera.
+
+Usage:
+    python camera_emulator.py --cameras 24 --fps 20 --jitter 0.01 --disconnect-rate 0.01
+    params.URL = 'http://127.0.0.1:8001/stream' for camera 0
+"""
+
+import time
+import random
+import asyncio
+import argparse
+import cv2
+import numpy as np
+
+from tune_detector import render_synthetic_frame, load_recorded_frames
+
+# same boundary and part header as app_httpd.cpp
+PART_BOUNDARY = "123456789000000000000987654321"
+STREAM_CONTENT_TYPE = f"multipart/x-mixed-replace;boundary={PART_BOUNDARY}"
+STREAM_BOUNDARY = f"\r\n--{PART_BOUNDARY}\r\n".encode()
+STREAM_PART = "Content-Type: image/jpeg\r\nContent-Length: {}\r\nX-Timestamp: {}.{:06d}\r\n\r\n"
+
+BASE_PORT = 8000
+
+class EmulatedCamera():
+    """
+    Class representing one emulated ESP32 camera with a capture and a stream server.
+
+    Attributes:
+        camera_id (int): Index of the emulated camera.
+        frames (list): Pre-encoded JPEG frames (bytes), played in a loop.
+        fps (float): Target frame rate of the stream.
+        jitter (float): Standard deviation of the frame interval in seconds.
+        disconnect_rate (float): Probability per second that the camera drops all connections.
+        downtime (float): Seconds the camera stays unreachable after a disconnect.
+        frames_sent (int): Number of frames sent on all streams.
+        bytes_sent (int): Number of JPEG bytes sent on all streams.
+        disconnects (int): Number of simulated disconnects.
+    Methods:
+        start(): Starts the capture and the stream server.
+        handle_capture(): Request handler of the capture server.
+        handle_stream(): Request handler of the stream server.
+    """
+    def __init__(self, camera_id, frames, fps, jitter, disconnect_rate, downtime):
+        self.camera_id = camera_id
+        self.frames = frames
+        self.fps = fps
+        self.jitter = jitter
+        self.disconnect_rate = disconnect_rate
+        self.downtime = downtime
+
+        # every camera starts at another frame of the loop
+        self.frame_index = camera_id * 7 % len(frames)
+        self.offline_until = 0.0
+        self.random = random.Random(camera_id)
+
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.disconnects = 0
+        self.clients = 0
+
+    async def start(self, host, base_port):
+        capture_port = base_port + 2 * self.camera_id
+        stream_port = capture_port + 1
+        await asyncio.start_server(self.handle_capture, host, capture_port)
+        await asyncio.start_server(self.handle_stream, host, stream_port)
+        return capture_port, stream_port
+
+    def next_frame(self):
+        """
+        Returns the next JPEG of the loop and its timestamp (seconds, microseconds) like fb->timestamp.
+        """
+        jpg = self.frames[self.frame_index]
+        self.frame_index = (self.frame_index + 1) % len(self.frames)
+        now = time.time()
+        return jpg, int(now), int((now % 1) * 1e6)
+
+    def is_offline(self):
+        return time.monotonic() < self.offline_until
+
+    async def read_request(self, reader, writer):
+        """
+        Reads the request line and headers. Returns the path or None if the camera is offline.
+        """
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if self.is_offline():
+            writer.close()
+            return None
+        parts = request_line.decode(errors='replace').split()
+        return parts[1].split('?')[0] if len(parts) > 1 else ""
+
+    async def send_not_found(self, writer):
+        writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def handle_capture(self, reader, writer):
+        """
+        Mimics capture_handler: one JPEG with Content-Disposition and X-Timestamp.
+        """
+        try:
+            path = await self.read_request(reader, writer)
+            if path is None:
+                return
+            if path != "/capture":
+                await self.send_not_found(writer)
+                return
+            jpg, seconds, microseconds = self.next_frame()
+            header = ("HTTP/1.1 200 OK\r\n"
+                      "Content-Type: image/jpeg\r\n"
+                      "Content-Disposition: inline; filename=capture.jpg\r\n"
+                      "Access-Control-Allow-Origin: *\r\n"
+                      f"X-Timestamp: {seconds}.{microseconds:06d}\r\n"
+                      f"Content-Length: {len(jpg)}\r\n"
+                      "Connection: close\r\n\r\n")
+            writer.write(header.encode() + jpg)
+            await writer.drain()
+            writer.close()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+    def write_chunk(self, writer, data):
+        # httpd_resp_send_chunk uses HTTP/1.1 chunked transfer encoding
+        writer.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    async def handle_stream(self, reader, writer):
+        """
+        Mimics stream_handler: endless multipart stream, one boundary, part header and JPEG chunk per frame.
+        """
+        try:
+            path = await self.read_request(reader, writer)
+            if path is None:
+                return
+            if path != "/stream":
+                await self.send_not_found(writer)
+                return
+            header = ("HTTP/1.1 200 OK\r\n"
+                      f"Content-Type: {STREAM_CONTENT_TYPE}\r\n"
+                      "Transfer-Encoding: chunked\r\n"
+                      "Access-Control-Allow-Origin: *\r\n"
+                      "X-Framerate: 60\r\n\r\n")
+            writer.write(header.encode())
+            self.clients += 1
+
+            next_time = time.monotonic()
+            while True:
+                # simulated disconnect: drop the connection without closing the chunked stream
+                if self.is_offline() or self.random.random() < self.disconnect_rate / self.fps:
+                    if not self.is_offline():
+                        self.disconnects += 1
+                        self.offline_until = time.monotonic() + self.downtime
+                    writer.transport.abort()
+                    break
+
+                jpg, seconds, microseconds = self.next_frame()
+                self.write_chunk(writer, STREAM_BOUNDARY)
+                self.write_chunk(writer, STREAM_PART.format(len(jpg), seconds, microseconds).encode())
+                self.write_chunk(writer, jpg)
+                await writer.drain()
+                self.frames_sent += 1
+                self.bytes_sent += len(jpg)
+
+                next_time += max(0.0, self.random.gauss(1.0 / self.fps, self.jitter))
+                await asyncio.sleep(max(0.0, next_time - time.monotonic()))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients = max(0, self.clients - 1)
+
+def prepare_frames(args):
+    """
+    Renders or loads the frames, resizes them and encodes them as JPEG.
+    Returns:
+        frames (list): JPEG encoded frames (bytes).
+    """
+    if args.images:
+        images = load_recorded_frames(args.images)
+    else:
+        rng = np.random.default_rng(args.seed)
+        images = [render_synthetic_frame(rng)[0] for _ in range(args.frames)]
+    if not images:
+        print("Error: no frames to serve")
+        exit(1)
+
+    frames = []
+    for image in images:
+        image = cv2.resize(image, (args.width, args.height), interpolation=cv2.INTER_AREA)
+        ret, jpg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, args.quality])
+        if ret:
+            frames.append(jpg.tobytes())
+    return frames
+
+async def print_stats(cameras, interval=5.0):
+    last = {camera.camera_id: 0 for camera in cameras}
+    while True:
+        await asyncio.sleep(interval)
+        total_fps = 0.0
+        for camera in cameras:
+            total_fps += (camera.frames_sent - last[camera.camera_id]) / interval
+            last[camera.camera_id] = camera.frames_sent
+        clients = sum(camera.clients for camera in cameras)
+        disconnects = sum(camera.disconnects for camera in cameras)
+        megabytes = sum(camera.bytes_sent for camera in cameras) / 1e6
+        print(f"{len(cameras)} cameras, {clients} clients, {total_fps:.1f} frames/s total, {megabytes:.1f} MB sent, {disconnects} disconnects")
+
+async def run(args):
+    frames = prepare_frames(args)
+    print(f"Serving {len(frames)} frames, mean JPEG size {np.mean([len(f) for f in frames]) / 1000:.1f} kB")
+
+    cameras = []
+    for camera_id in range(args.cameras):
+        camera = EmulatedCamera(camera_id, frames, args.fps, args.jitter, args.disconnect_rate, args.downtime)
+        capture_port, stream_port = await camera.start(args.host, args.base_port)
+        print(f"Cam {camera_id}: http://{args.host}:{capture_port}/capture  http://{args.host}:{stream_port}/stream")
+        cameras.append(camera)
+    await print_stats(cameras)
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a fleet of ESP32 CameraWebServer boards.")
+    parser.add_argument('--cameras', type=int, default=6, help="number of emulated cameras")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=BASE_PORT, help="capture port of camera 0, stream port is +1")
+    parser.add_argument('--fps', type=float, default=20.0)
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('--quality', type=int, default=80, help="JPEG quality (0-100)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="standard deviation of the frame interval in seconds")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help="disconnects per second and camera")
+    parser.add_argument('--downtime', type=float, default=2.0, help="seconds a camera is unreachable after a disconnect")
+    parser.add_argument('--images', help="folder with recorded frames or a video file instead of synthetic frames")
+    parser.add_argument('--frames', type=int, default=50, help="number of synthetic frames in the loop")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
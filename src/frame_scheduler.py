@@ -0,0 +1,195 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Deadline aware scheduling of the main loop.
+Every frame has a budget of params.FRAME_BUDGET_SECONDS. The duration of every stage of the loop is measured,
+and when frames repeatedly come close to the budget because of work that can be shed (render, detect, solve),
+work is shed in a fixed order (degradation levels):
+    1. skip the render (camera window and matplotlib redraw)
+    2. lower the detection resolution (params.DEGRADED_DETECTION_SCALE)
+    3. detect only in a region of interest around the last detections
+    4. defer the solve (params.DEFERRED_SOLVE_SECONDS instead of every second)
+The frames at risk are counted over a sliding time window, so the slow frame of the once per second solve and
+redraw raises the level as well, although the frames between are fast.
+Frames that are slow because of the camera read alone do not raise the level, shedding would not help them.
+Consecutive frames well below the budget, without a frame at risk in the window, lower the level step by step.
+Deadline misses, level changes and the worst frame time per level are recorded.
+"""
+
+import time
+from collections import deque
+import numpy as np
+import params as params
+
+LEVEL_NORMAL = 0
+LEVEL_SKIP_RENDER = 1
+LEVEL_LOW_RESOLUTION = 2
+LEVEL_ROI = 3
+LEVEL_DEFER_SOLVE = 4
+
+LEVEL_NAMES = ['normal', 'skip render', 'low resolution', 'roi detection', 'defer solve']
+
+# stages whose work the levels can shed, the camera read and the MQTT publish cannot be shed
+SHEDDABLE_STAGES = ('detect', 'solve', 'render')
+
+class FrameScheduler():
+    """
+    Measures the stages of every frame and selects the degradation level for the next frame.
+
+    Attributes:
+        budget (float): Frame budget in seconds.
+        level (int): Current degradation level (LEVEL_NORMAL ... LEVEL_DEFER_SOLVE).
+        stage_times (dict): stage name: recent durations in seconds.
+        frame_stages (dict): stage name: duration in seconds of the current frame.
+        misses (int): Number of frames over budget.
+        recoveries (int): Number of times the level went back to LEVEL_NORMAL.
+        worst_frame (list): Worst frame time per level.
+    Methods:
+        start_frame(): Starts the time measurement of a frame.
+        mark(): Ends the current stage.
+        end_frame(): Ends the frame, records misses and adapts the level.
+        render_enabled(), detection_scale(), detection_roi(), solve_interval(): Work allowed at the current level.
+        get_report(): Returns the statistics as text.
+    """
+    def __init__(self, budget=params.FRAME_BUDGET_SECONDS):
+        self.budget = budget
+        self.level = LEVEL_NORMAL
+        self.frame_start = None
+        self.stage_start = None
+        self.frame_count = 0
+        self.detection_count = 0
+        self.fast_frames = 0
+        self.risk_times = deque()
+
+        self.stage_times = {}
+        self.frame_stages = {}
+        self.frame_times = deque(maxlen=1000)
+        self.misses = 0
+        self.recoveries = 0
+        self.level_changes = []
+        self.worst_frame = [0.0] * len(LEVEL_NAMES)
+        self.frames_per_level = [0] * len(LEVEL_NAMES)
+
+    def start_frame(self):
+        self.frame_start = self.stage_start = time.perf_counter()
+        self.frame_count += 1
+        self.frame_stages = {}
+
+    def mark(self, stage):
+        """
+        Ends the current stage and starts the next one.
+        Args:
+            stage (str): Name of the stage that just finished.
+        """
+        now = time.perf_counter()
+        self.stage_times.setdefault(stage, deque(maxlen=1000)).append(now - self.stage_start)
+        self.frame_stages[stage] = self.frame_stages.get(stage, 0.0) + now - self.stage_start
+        self.stage_start = now
+
+    def end_frame(self):
+        """
+        Ends the frame. A frame is at risk if it is over params.FRAME_RISK_RATIO of the budget and would be below it
+        without the sheddable stages (SHEDDABLE_STAGES), so a slow camera read alone never raises the level.
+        params.FRAME_RISK_FRAMES frames at risk within params.FRAME_RISK_WINDOW_SECONDS raise the level by one,
+        they do not have to be consecutive, so a periodic overrun of the solve or the render is shed too.
+        params.FRAME_RECOVER_FRAMES consecutive frames under params.FRAME_RECOVER_RATIO of the budget lower it by one,
+        but only if no frame in the window was at risk, so the level does not flap under periodic load.
+        Returns:
+            frame_time (float): Duration of the frame in seconds.
+        """
+        frame_time = time.perf_counter() - self.frame_start
+        self.frame_times.append(frame_time)
+        self.frames_per_level[self.level] += 1
+        self.worst_frame[self.level] = max(self.worst_frame[self.level], frame_time)
+        if frame_time > self.budget:
+            self.misses += 1
+
+        now = self.frame_start + frame_time
+        while self.risk_times and now - self.risk_times[0] > params.FRAME_RISK_WINDOW_SECONDS:
+            self.risk_times.popleft()
+
+        risk_time = self.budget * params.FRAME_RISK_RATIO
+        sheddable_time = sum(self.frame_stages.get(stage, 0.0) for stage in SHEDDABLE_STAGES)
+        if frame_time > risk_time and frame_time - sheddable_time < risk_time:
+            self.fast_frames = 0
+            self.risk_times.append(now)
+            if len(self.risk_times) >= params.FRAME_RISK_FRAMES and self.level < LEVEL_DEFER_SOLVE:
+                # the next level has to prove itself with new frames at risk
+                self.risk_times.clear()
+                self.set_level(self.level + 1, frame_time)
+        elif frame_time < self.budget * params.FRAME_RECOVER_RATIO:
+            self.fast_frames += 1
+            if self.fast_frames >= params.FRAME_RECOVER_FRAMES and not self.risk_times and self.level > LEVEL_NORMAL:
+                self.fast_frames = 0
+                self.set_level(self.level - 1, frame_time)
+                if self.level == LEVEL_NORMAL:
+                    self.recoveries += 1
+        else:
+            self.fast_frames = 0
+        return frame_time
+
+    def set_level(self, level, frame_time):
+        self.level_changes.append((time.time(), self.level, level, frame_time))
+        print(f"Scheduler: {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]} (frame {1000 * frame_time:.1f} ms, budget {1000 * self.budget:.0f} ms)")
+        self.level = level
+
+    def render_enabled(self):
+        return self.level < LEVEL_SKIP_RENDER
+
+    def detection_scale(self):
+        return params.DEGRADED_DETECTION_SCALE if self.level >= LEVEL_LOW_RESOLUTION else 1.0
+
+    def solve_interval(self):
+        return params.DEFERRED_SOLVE_SECONDS if self.level >= LEVEL_DEFER_SOLVE else 1.0
+
+    def detection_roi(self, markers, frame_shape):
+        """
+        Returns the region of interest around the last detections at LEVEL_ROI and above.
+        Called once per detection run. Every params.ROI_FULL_FRAME_EVERY detection runs the full frame is used
+        to find new markers, counted in detections and not in frames because the motion gate skips frames.
+        Args:
+            markers (list): ArucoMarker objects of the last detections.
+            frame_shape (tuple): Shape of the frame.
+        Returns:
+            roi (tuple): (x0, y0, x1, y1) in pixels, or None for the full frame.
+        """
+        self.detection_count += 1
+        if self.level < LEVEL_ROI or not markers or self.detection_count % params.ROI_FULL_FRAME_EVERY == 0:
+            return None
+        height, width = frame_shape[:2]
+        fx, fy = params.CAMERA_MATRIX[0, 0], params.CAMERA_MATRIX[1, 1]
+        cx, cy = params.CAMERA_MATRIX[0, 2], params.CAMERA_MATRIX[1, 2]
+        cube_size = params.MARKERLENGTH + 2 * params.CUBE_MARKER_OFFSET
+
+        x0, y0, x1, y1 = width, height, 0, 0
+        for marker in markers:
+            x, y, z = marker.tvecs
+            if z <= 0:
+                return None
+            u, v = fx * x / z + cx, fy * y / z + cy
+            radius = params.ROI_MARGIN * cube_size * max(fx, fy) / z
+            x0, y0 = min(x0, u - radius), min(y0, v - radius)
+            x1, y1 = max(x1, u + radius), max(y1, v + radius)
+
+        x0, y0 = max(0, int(x0)), max(0, int(y0))
+        x1, y1 = min(width, int(np.ceil(x1))), min(height, int(np.ceil(y1)))
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1, y1
+
+    def get_report(self):
+        """
+        Returns the statistics of the scheduler as text.
+        """
+        lines = [f"Scheduler: level {LEVEL_NAMES[self.level]}, {self.frame_count} frames, {self.misses} deadline misses, "
+                 f"{self.recoveries} recoveries, worst frame {1000 * max(self.worst_frame):.1f} ms (budget {1000 * self.budget:.0f} ms)"]
+        for stage, times in self.stage_times.items():
+            p50, p99, worst = np.percentile(times, [50, 99, 100]) * 1000
+            lines.append(f"  {stage:<8} p50 {p50:6.2f} ms, p99 {p99:6.2f} ms, max {worst:6.2f} ms")
+        for level, name in enumerate(LEVEL_NAMES):
+            if self.frames_per_level[level]:
+                lines.append(f"  {name:<15} {self.frames_per_level[level]} frames, worst {1000 * self.worst_frame[level]:.1f} ms")
+        return "\n".join(lines)
@@ -10,21 +10,30 @@ It also triggers the visualization of marker positions and updates the JSON file
 """
 
 import json
+import time
 import cv2
 import cv2.aruco as aruco
 import numpy as np
+import pandas as pd
 from datetime import datetime
 import matplotlib.pyplot as plt     
 import matplotlib.animation as animation
 from matplotlib.lines import Line2D
 
-from utils import setup_camera_stream, get_frame, get_marker_detections, get_camera_dict
+from utils import setup_camera_stream, get_frame, get_marker_detections, get_camera_dict, handle_camera_message, MotionGate
 from process_positions import process_positions
+from pose_history import PoseHistory
+from state_journal import StateJournal
+from frame_scheduler import FrameScheduler
 import params as params
 import paho.mqtt.client as mqtt
 import threading
 
 json_lock = threading.Lock()
+pose_history = PoseHistory()
+state_journal = StateJournal()
+global_camera_poses_positions = None
+service_stats = {'start': datetime.now(), 'first_poses': None, 'poses_time': None, 'local_solve': True}
 
 
 marker_positions = [
@@ -70,26 +79,32 @@ def on_message(client, userdata, msg):
     Callback function for MQTT messages.
     Updates the marker positions in the JSON file based on the received message.
     """
+    global global_camera_poses_positions
     try:
+        # retained results of the solver service, an empty payload clears them (failed solve or service offline)
+        if msg.topic == params.TOPIC_GLOBAL_POSES:
+            if not msg.payload:
+                service_stats['poses_time'] = None
+                return
+            new_data = json.loads(msg.payload.decode())
+            poses_time = datetime.strptime(new_data['time'], "%Y-%m-%d %H:%M:%S")
+            if (datetime.now() - poses_time).total_seconds() > params.SOLVER_SERVICE_TIMEOUT:
+                return
+            service_stats['poses_time'] = poses_time
+            global_camera_poses_positions = pd.DataFrame(new_data['cameras'])
+            if service_stats['first_poses'] is None:
+                service_stats['first_poses'] = (datetime.now() - service_stats['start']).total_seconds()
+                print(f"Solver service: first global poses {service_stats['first_poses']:.2f} s after start")
+            return
         new_data = json.loads(msg.payload.decode())
+        if msg.topic == params.TOPIC_GLOBAL_STATE:
+            for camera_dict in new_data['cameras']:
+                if camera_dict['id'] != params.CAMERA_ID and camera_dict['time'] != "":
+                    handle_camera_message(marker_positions, camera_dict['id'], camera_dict, pose_history, state_journal)
+            return
         print(f"Received message from {msg.topic}: {new_data}")
-        new_data_camera_id = int(str(msg.topic)[-1])
-        for camera_dict in marker_positions:
-            if camera_dict['id'] == new_data_camera_id:
-                if camera_dict["time"] == "":
-                    camera_dict['Others'] = new_data.get('Others', camera_dict['Others'])
-                    camera_dict['time'] = new_data.get('time', camera_dict['time'])
-                    #print(f"add marker_positions, message from {new_data_camera_id} : {marker_positions}")
-                    break
-                old_time_stamp = camera_dict["time"]
-                old_time_stamp = datetime.now().strptime(old_time_stamp, "%Y-%m-%d %H:%M:%S")
-                new_time_stamp = new_data["time"] 
-                new_time_stamp = datetime.now().strptime(new_time_stamp, "%Y-%m-%d %H:%M:%S")
-                if old_time_stamp < new_time_stamp:
-                    camera_dict['Others'] = new_data.get('Others', camera_dict['Others'])
-                    camera_dict['time'] = new_data.get('time', camera_dict['time'])
-                    #print(f"update marker_positions, message from {new_data_camera_id} : {marker_positions}")
-                    break
+        new_data_camera_id = int(str(msg.topic).rsplit('/', 1)[-1])
+        handle_camera_message(marker_positions, new_data_camera_id, new_data, pose_history, state_journal)
     except Exception as e:
         print(f"Error processing message: {e}")
 
@@ -139,6 +154,14 @@ def visualize_camera_positions(df=None, ax=None, fig=None):
     plt.tight_layout()
     plt.show()
 
+#--------------------------------------------------------------------------------#
+# Warm start from the state journal
+#--------------------------------------------------------------------------------#
+marker_positions = state_journal.load(marker_positions)
+for camera_dict in marker_positions:
+    if camera_dict["time"] != "":
+        pose_history.add_camera_dict(camera_dict)
+
 #--------------------------------------------------------------------------------#
 # MQTT Setup
 #--------------------------------------------------------------------------------#
@@ -150,6 +173,8 @@ client.connect(params.BROKER, params.PORT, 60)
 # subscribe topics of all cameras except the current one
 clients = [(params.TOPIC_1, 1), (params.TOPIC_2, 1), (params.TOPIC_3, 1), (params.TOPIC_4, 1), (params.TOPIC_5, 1), (params.TOPIC_6, 1)]
 clients.pop(params.CAMERA_ID-1)
+if params.USE_SOLVER_SERVICE:
+    clients += [(params.TOPIC_GLOBAL_POSES, 1), (params.TOPIC_GLOBAL_STATE, 1)]
 client.subscribe(clients)
 client.loop_start()
 
@@ -157,6 +182,8 @@ client.loop_start()
 cap = setup_camera_stream()
 
 markers = []
+motion_gate = MotionGate()
+frame_scheduler = FrameScheduler()
 prev_second = datetime.now()
 prev_5_second = datetime.now()
 
@@ -167,16 +194,30 @@ fig, ax = plt.subplots(figsize=(6, 6))
 if __name__ == "__main__":
     while True:
         now = datetime.now()
+        frame_scheduler.start_frame()
 
         # 1. get the current frame from the own camera
         frame, photo_timestamp = get_frame(cap)     
-        cv2.imshow("ESP32 Cam Stream", frame)
+        if frame_scheduler.render_enabled():
+            cv2.imshow("ESP32 Cam Stream", frame)
+        frame_scheduler.mark('read')
 
-        # 2. detect markers in the current frame
-        detected_markers = get_marker_detections(frame, photo_timestamp)
+        # 2. detect markers in the current frame, skip the detection if the scene did not change
+        #    the last result stays in markers / marker_positions, the forced refresh of the gate keeps it alive
+        #    under load the scheduler lowers the resolution or restricts the detection to the last markers
+        if motion_gate.frame_changed(frame, photo_timestamp):
+            detection_start = time.perf_counter()
+            detected_markers = get_marker_detections(frame, photo_timestamp,
+                                                     frame_scheduler.detection_scale(),
+                                                     frame_scheduler.detection_roi(markers, frame.shape))
+            motion_gate.add_detection_time(time.perf_counter() - detection_start)
+        else:
+            detected_markers = []
+        frame_scheduler.mark('detect')
 
         # 3. update detected marker objects
         for new_marker in detected_markers:
+            pose_history.add(params.CAMERA_ID, new_marker.detected_id, photo_timestamp.timestamp(), new_marker.rvecs, new_marker.tvecs)
             match_found = False
 
             for i, existing_marker in enumerate(markers):
@@ -185,7 +226,8 @@ if __name__ == "__main__":
                         marker_positions,
                         photo_timestamp,
                         new_marker.rvecs,
-                        new_marker.tvecs
+                        new_marker.tvecs,
+                        new_marker.quality
                     )
                     match_found = True
                     break
@@ -196,7 +238,8 @@ if __name__ == "__main__":
                     marker_positions,
                     photo_timestamp,
                     new_marker.rvecs,
-                    new_marker.tvecs
+                    new_marker.tvecs,
+                    new_marker.quality
                 )
         detected_markers = [] 
         
@@ -206,14 +249,27 @@ if __name__ == "__main__":
                 print(f"Removing marker {marker.detected_id} due to inactivity.")
                 marker_positions = marker.delete_position(marker_positions)
                 markers.remove(marker)
+        frame_scheduler.mark('update')
 
-        # 5. redraw the network every second
-        if (now - prev_second).total_seconds() > 1:
-            global_camera_poses_positions = process_positions(marker_positions)
-            visualize_camera_positions(global_camera_poses_positions, ax, fig)
-            fig.canvas.draw()    
-            fig.canvas.flush_events() 
+        # 5. solve and redraw the network every second, the solver service solves for the edge nodes if enabled
+        #    without recent poses of the service (service offline or anchor lost) the edge node solves locally
+        #    under load the scheduler skips the redraw and defers the solve
+        if (now - prev_second).total_seconds() > frame_scheduler.solve_interval():
+            poses_time = service_stats['poses_time']
+            local_solve = (not params.USE_SOLVER_SERVICE or poses_time is None
+                           or (now - poses_time).total_seconds() > params.SOLVER_SERVICE_TIMEOUT)
+            if params.USE_SOLVER_SERVICE and local_solve != service_stats['local_solve']:
+                print("Solver service: no recent poses, solving locally" if local_solve else "Solver service: using global poses")
+            service_stats['local_solve'] = local_solve
+            if local_solve:
+                global_camera_poses_positions = process_positions(marker_positions, pose_history)
+            frame_scheduler.mark('solve')
+            if frame_scheduler.render_enabled():
+                visualize_camera_positions(global_camera_poses_positions, ax, fig)
+                fig.canvas.draw()    
+                fig.canvas.flush_events() 
             prev_second = datetime.now()
+        frame_scheduler.mark('render')
 
         # 6. publish camera data every 5 seconds
         if (now - prev_5_second).total_seconds() > 5:
@@ -223,4 +279,9 @@ if __name__ == "__main__":
                 client.publish(params.TOPIC_5, json.dumps(camera_dict))
                 print(f"Published data for camera {params.CAMERA_ID} to MQTT broker.: {camera_dict}")
             prev_5_second = datetime.now()
-            print("5 Seconds")
\ No newline at end of file
+            print("5 Seconds")
+            gate_stats = motion_gate.get_stats()
+            print(f"Motion gate: skipped {gate_stats['skipped']}/{gate_stats['frames']} frames ({gate_stats['skip_ratio']:.0%}), saved approx. {gate_stats['saved_seconds']:.2f} s detection time")
+            print(frame_scheduler.get_report())
+        frame_scheduler.mark('publish')
+        frame_scheduler.end_frame()
\ No newline at end of file
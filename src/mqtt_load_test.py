@@ -0,0 +1,328 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Load generator for the MQTT peer traffic.
+Simulates many peer cameras that publish get_camera_dict shaped payloads at a configurable rate,
+either to a real broker (--broker) or to an embedded in-process broker stand-in (default).
+The peers form a fixed observation graph like a real fleet: a subset of them sees the origin cube (markers 0-3),
+every peer sees the markers peer_id * 10 + face of other simulated peers, so process_positions walks a real graph.
+The receiving side runs handle_camera_message like on_message in main.py (merge, pose history and state journal),
+a solver thread runs process_positions with the pose history once per second and a detection thread runs
+a fixed workload with the Python level per frame work of the main loop to show starvation by the callback thread.
+
+Measured:
+- callback latency (publish -> callback) and callback duration
+- dropped (sequence gaps), out-of-order and rejected (not newer timestamp) updates
+- duration of the solve, number of solved cameras and staleness of the peer data at solve time
+- iteration rate of the detection loop compared to an idle baseline
+
+Every payload carries two extra keys, 'seq' and 'sent', which on_message ignores.
+
+Usage:
+    python mqtt_load_test.py --peers 300 --rate 1 --duration 20
+    python mqtt_load_test.py --peers 100 --rate 5 --broker 127.0.0.1
+"""
+
+import os
+import json
+import time
+import heapq
+import queue
+import tempfile
+import argparse
+import threading
+import cv2
+import numpy as np
+from datetime import datetime
+from collections import namedtuple
+
+import params as params
+from utils import handle_camera_message, ArucoMarker, get_camera_dict
+from pose_history import PoseHistory
+from state_journal import StateJournal
+from process_positions import process_positions
+
+LocalMessage = namedtuple('LocalMessage', ['topic', 'payload'])
+
+class LocalBroker():
+    """
+    In-process stand-in for the MQTT broker.
+    Messages are queued and delivered from one network thread, like the loop_start() thread of paho.
+
+    Methods:
+        publish(): Queues a message.
+        loop_start(): Starts the delivery thread.
+        loop_stop(): Stops the delivery thread.
+    """
+    def __init__(self):
+        self.on_message = None
+        self.messages = queue.Queue()
+        self.thread = None
+
+    def publish(self, topic, payload):
+        self.messages.put(LocalMessage(topic, payload.encode()))
+
+    def loop_start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def loop_stop(self):
+        self.messages.put(None)
+        self.thread.join()
+
+    def loop(self):
+        while True:
+            msg = self.messages.get()
+            if msg is None:
+                break
+            self.on_message(self, None, msg)
+
+class LoadStats():
+    """
+    Collects the measurements of the receiving side.
+
+    Methods:
+        on_message(): MQTT callback, handles the message like main.py and records latency and ordering.
+        record_solve(): Records the staleness of the peer data at solve time.
+        print_report(): Prints the summary.
+    """
+    def __init__(self, marker_positions, pose_history, state_journal):
+        self.marker_positions = marker_positions
+        self.pose_history = pose_history
+        self.state_journal = state_journal
+        self.lock = threading.Lock()
+        self.last_seq = {}
+        self.last_update = {}
+        self.latencies = []
+        self.durations = []
+        self.staleness = []
+        self.received = 0
+        self.dropped = 0
+        self.out_of_order = 0
+        self.rejected = 0
+
+    def on_message(self, client, userdata, msg):
+        start = time.time()
+        try:
+            new_data = json.loads(msg.payload.decode())
+            camera_id = int(str(msg.topic).rsplit('/', 1)[-1])
+            with self.lock:
+                updated = handle_camera_message(self.marker_positions, camera_id, new_data, self.pose_history, self.state_journal)
+                if updated:
+                    self.last_update[camera_id] = new_data['sent']
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            return
+
+        seq = new_data['seq']
+        last_seq = self.last_seq.get(camera_id, -1)
+        if seq < last_seq:
+            self.out_of_order += 1
+        else:
+            self.dropped += seq - last_seq - 1
+            self.last_seq[camera_id] = seq
+        self.received += 1
+        self.rejected += not updated
+        self.latencies.append(start - new_data['sent'])
+        self.durations.append(time.time() - start)
+
+    def record_solve(self, now):
+        with self.lock:
+            if self.last_update:
+                self.staleness.append(now - min(self.last_update.values()))
+
+    def print_report(self, published, duration, detection_rate, baseline_rate, solve_times, solved_counts):
+        def percentiles(values, scale=1000, unit="ms"):
+            if not values:
+                return "n/a"
+            p50, p99, p_max = np.percentile(values, [50, 99, 100]) * scale
+            return f"p50 {p50:.2f} {unit}, p99 {p99:.2f} {unit}, max {p_max:.2f} {unit}"
+
+        print(f"\nPublished {published} messages in {duration:.1f} s ({published / duration:.0f} msg/s), received {self.received}")
+        print(f"Callback latency:  {percentiles(self.latencies)}")
+        print(f"Callback duration: {percentiles(self.durations)}")
+        print(f"Dropped {self.dropped}, out of order {self.out_of_order}, rejected as not newer {self.rejected}")
+        print(f"Solver: {len(solve_times)} solves, duration {percentiles(solve_times)}, staleness of oldest peer {percentiles(self.staleness, 1, 's')}")
+        if solved_counts:
+            print(f"Solved cameras per solve: min {min(solved_counts)}, max {max(solved_counts)} of {len(self.marker_positions)}")
+        print(f"Detection loop: {detection_rate:.1f} it/s under load, {baseline_rate:.1f} it/s idle ({detection_rate / baseline_rate:.0%})")
+
+def build_peer_graph(peers, markers_per_peer, anchor_peers, rng):
+    """
+    Assigns the markers every peer sees. The first anchor_peers peers see one marker of the origin cube,
+    all peers see markers (peer_id * 10 + face) of other randomly chosen peers.
+    Args:
+        peers (list): IDs of the simulated peers.
+        markers_per_peer (int): Number of peer markers every peer sees.
+        anchor_peers (int): Number of peers that see the origin cube.
+        rng (np.random.Generator): Random generator.
+    Returns:
+        observed (dict): camera_id: list of detected marker IDs.
+    """
+    observed = {}
+    for index, camera_id in enumerate(peers):
+        others = [peer for peer in peers if peer != camera_id]
+        seen = rng.choice(others, size=min(markers_per_peer, len(others)), replace=False)
+        observed[camera_id] = [int(peer) * 10 + int(rng.integers(0, 4)) for peer in seen]
+        if index < anchor_peers:
+            observed[camera_id].append(int(rng.choice(sorted(params.ANCHOR_MARKER_IDS))))
+    return observed
+
+def build_peer_payload(camera_id, seq, observed_ids, rng):
+    """
+    Builds a payload in the shape of get_camera_dict with random poses of the observed markers.
+    """
+    others = []
+    for detected_id in observed_ids:
+        others.append({
+            'detected_id': int(detected_id),
+            'Position': [{'rvecs': rng.normal(0, 1, 3).tolist()}, {'tvecs': rng.uniform(-0.3, 0.3, 3).tolist()}],
+            'timestamp': time.time()
+        })
+    return {
+        'id': camera_id,
+        'Others': others,
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'seq': seq,
+        'sent': time.time()
+    }
+
+def publish_peers(publisher, peers, rate, observed, duration, stop_event):
+    """
+    Publishes the payloads of all peers, each with the given rate. Returns the number of messages.
+    """
+    rng = np.random.default_rng(0)
+    start = time.monotonic()
+    # (next send time, camera id, seq), peers start with a random phase
+    schedule = [(start + rng.uniform(0, 1.0 / rate), camera_id, 0) for camera_id in peers]
+    heapq.heapify(schedule)
+    published = 0
+    while schedule and not stop_event.is_set():
+        send_time, camera_id, seq = heapq.heappop(schedule)
+        if send_time - start > duration:
+            break
+        delay = send_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        payload = build_peer_payload(camera_id, seq, observed[camera_id], rng)
+        publisher.publish(f"{params.TOPIC_PREFIX}/{camera_id}", json.dumps(payload))
+        published += 1
+        heapq.heappush(schedule, (send_time + 1.0 / rate, camera_id, seq + 1))
+    return published
+
+def detection_workload(stop_event, counter, pose_history, frame_shape=(240, 320), markers_per_frame=4):
+    """
+    Stands in for the detection loop of main.py, a fixed workload per iteration:
+    image processing (releases the GIL) and the Python level work of steps 3 and 5 of the main loop
+    (marker objects, update of marker_positions, pose history, serialization of the camera dict), which needs the GIL.
+    """
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 255, frame_shape, dtype=np.uint8)
+    own_positions = [{'id': params.CAMERA_ID, 'Others': [], 'time': ""}]
+    while not stop_event.is_set():
+        cv2.adaptiveThreshold(frame, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 13, 7)
+        timestamp = datetime.now()
+        for detected_id in range(markers_per_frame):
+            rvec, tvec = rng.normal(0, 1, 3).tolist(), rng.uniform(-0.3, 0.3, 3).tolist()
+            marker = ArucoMarker(detected_id, rvec, tvec, timestamp)
+            own_positions = marker.update_position(own_positions, timestamp, rvec, tvec, 1.0)
+            pose_history.add(params.CAMERA_ID, detected_id, timestamp.timestamp(), rvec, tvec)
+        json.dumps(get_camera_dict(params.CAMERA_ID, own_positions))
+        counter[0] += 1
+
+def measure_detection_rate(seconds):
+    stop_event = threading.Event()
+    counter = [0]
+    thread = threading.Thread(target=detection_workload, args=(stop_event, counter, PoseHistory()), daemon=True)
+    thread.start()
+    time.sleep(seconds)
+    stop_event.set()
+    thread.join()
+    return counter[0] / seconds
+
+def solver_loop(stats, stop_event, solve_times, solved_counts):
+    """
+    Runs process_positions with the pose history once per second on a snapshot of the merged data, like step 5 in main.py.
+    """
+    while not stop_event.wait(1.0):
+        with stats.lock:
+            snapshot = json.loads(json.dumps(stats.marker_positions))
+        start = time.perf_counter()
+        global_camera_poses_positions = process_positions(snapshot, stats.pose_history)
+        solve_times.append(time.perf_counter() - start)
+        solved_counts.append(0 if global_camera_poses_positions is None else len(global_camera_poses_positions))
+        stats.record_solve(time.time())
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate MQTT traffic of many peer cameras.")
+    parser.add_argument('--peers', type=int, default=100, help="number of simulated peer cameras")
+    parser.add_argument('--rate', type=float, default=0.2, help="messages per second and peer (main.py publishes every 5 s)")
+    parser.add_argument('--markers', type=int, default=4, help="markers of other peers per payload")
+    parser.add_argument('--anchor-peers', type=int, default=5, help="number of peers that see the origin cube")
+    parser.add_argument('--duration', type=float, default=15.0, help="test duration in seconds")
+    parser.add_argument('--broker', help="use a real broker instead of the embedded stand-in")
+    parser.add_argument('--port', type=int, default=params.PORT)
+    args = parser.parse_args()
+
+    # peers get IDs above the real cameras so the own camera is never overwritten
+    peers = list(range(100, 100 + args.peers))
+    marker_positions = [{'id': camera_id, 'Others': [], 'time': ""} for camera_id in peers]
+    # journal in a temporary folder, the warm start files of main.py are not touched
+    journal_folder = tempfile.mkdtemp()
+    state_journal = StateJournal(os.path.join(journal_folder, 'journal.jsonl'), os.path.join(journal_folder, 'snapshot.json'))
+    state_journal.load(marker_positions)
+    pose_history = PoseHistory()
+    stats = LoadStats(marker_positions, pose_history, state_journal)
+    observed = build_peer_graph(peers, args.markers, args.anchor_peers, np.random.default_rng(1))
+
+    print("Measuring idle detection loop rate ...")
+    baseline_rate = measure_detection_rate(3.0)
+
+    if args.broker:
+        import paho.mqtt.client as mqtt
+        receiver = mqtt.Client()
+        receiver.on_message = stats.on_message
+        receiver.connect(args.broker, args.port, 60)
+        receiver.subscribe(f"{params.TOPIC_PREFIX}/+", 1)
+        receiver.loop_start()
+        publisher = mqtt.Client()
+        publisher.connect(args.broker, args.port, 60)
+        publisher.loop_start()
+    else:
+        receiver = LocalBroker()
+        receiver.on_message = stats.on_message
+        receiver.loop_start()
+        publisher = receiver
+
+    stop_event = threading.Event()
+    counter = [0]
+    solve_times = []
+    solved_counts = []
+    detection_thread = threading.Thread(target=detection_workload, args=(stop_event, counter, pose_history), daemon=True)
+    solver_thread = threading.Thread(target=solver_loop, args=(stats, stop_event, solve_times, solved_counts), daemon=True)
+    detection_thread.start()
+    solver_thread.start()
+
+    print(f"Publishing {args.peers} peers at {args.rate} Hz for {args.duration} s ...")
+    start = time.monotonic()
+    published = publish_peers(publisher, peers, args.rate, observed, args.duration, stop_event)
+    duration = time.monotonic() - start
+    detection_rate = counter[0] / duration
+
+    # give the network thread time to deliver the remaining messages
+    time.sleep(1.0)
+    stop_event.set()
+    detection_thread.join()
+    solver_thread.join()
+    if args.broker:
+        publisher.loop_stop()
+    receiver.loop_stop()
+    state_journal.stop()
+
+    stats.print_report(published, duration, detection_rate, baseline_rate, solve_times, solved_counts)
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, Univ
 This module contains parameters for camera calibration, MQTT topics, and marker configurations.
 """
 
+import os
+import json
 import numpy as np
 import cv2.aruco as aruco
 
@@ -31,6 +33,90 @@ MARKERLENGTH = 0.02
 
 aruco_dict = aruco.getPredefinedDictionary(aruco.DICT_6X6_250)
 parameters = aruco.DetectorParameters()
+# marker IDs of a reduced dictionary, index in the dictionary -> marker ID (None: full dictionary)
+ARUCO_MARKER_IDS = None
+
+# detector profile written by tune_detector.py, loaded instead of the defaults if it exists
+DETECTOR_PROFILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'detector_profile.json')
+
+def build_detector_setup(profile):
+    """
+    Creates the dictionary and the detector parameters of a detector profile.
+    Args:
+        profile (dict): Profile with the keys 'dictionary', 'marker_ids' and 'parameters'.
+    Returns:
+        tuple (aruco_dict, parameters, marker_ids): marker_ids is None if the full dictionary is used.
+    """
+    dictionary = aruco.getPredefinedDictionary(getattr(aruco, profile.get('dictionary', 'DICT_6X6_250')))
+    detector_parameters = aruco.DetectorParameters()
+    for name, value in profile.get('parameters', {}).items():
+        setattr(detector_parameters, name, value)
+
+    marker_ids = profile.get('marker_ids')
+    if marker_ids:
+        marker_ids = np.array(marker_ids, dtype=np.int32)
+        dictionary = aruco.Dictionary(dictionary.bytesList[marker_ids], dictionary.markerSize, dictionary.maxCorrectionBits)
+    else:
+        marker_ids = None
+    return dictionary, detector_parameters, marker_ids
+
+def load_detector_profile(path=DETECTOR_PROFILE_PATH):
+    """
+    Loads the detector parameters and the (reduced) dictionary from a profile JSON file.
+    Args:
+        path (str): Path to the profile written by tune_detector.py.
+    Returns:
+        tuple (aruco_dict, parameters, marker_ids): marker_ids is None if the full dictionary is used.
+    """
+    with open(path, 'r') as file:
+        profile = json.load(file)
+    return build_detector_setup(profile)
+
+if os.path.exists(DETECTOR_PROFILE_PATH):
+    aruco_dict, parameters, ARUCO_MARKER_IDS = load_detector_profile()
+
+# cube pose estimation: all visible markers of one cube are solved together in one PnP
+# the markers sit on the faces of a cube, CUBE_MARKER_OFFSET is the distance from the cube center to a face
+CUBE_POSE_ESTIMATION = True
+CUBE_MARKER_OFFSET = MARKERLENGTH / 2
+
+# detection quality gating
+# quality = exp(-reprojection error / scale) * cos(viewing angle), independent of the distance
+# with the threshold a frontal marker needs a reprojection error below ~1.4 px, a clean one a viewing angle below ~75 deg
+QUALITY_REPROJECTION_SCALE = 1.0    # reprojection error in pixels that reduces the quality to 1/e
+QUALITY_THRESHOLD = 0.25            # detections below are dropped before they are stored and published
+# ranking of the edges in the solver: quality * min(1, expected pixel area / full area), area from the distance
+QUALITY_FULL_AREA = 400.0           # marker area in pixels from which the size no longer lowers the rank
+
+# motion gating of the detection
+# frames are compared on a downscaled grayscale image, detection is skipped if nothing changed
+MOTION_DOWNSCALE = 8                # factor by which the frame is shrunk before comparing
+MOTION_THRESHOLD = 12.0             # gray value difference of one downscaled cell (8x8 pixels) that counts as motion
+MOTION_REFRESH_SECONDS = 2.0        # forced detection interval, must stay below the 5 s marker expiry
+
+# pose history: timestamped poses per (camera, marker) pair for time aligned solving
+POSE_HISTORY_SECONDS = 10.0         # time span kept per pair, must cover the 5 s publish period of the peers
+POSE_HISTORY_RATE = 10.0            # maximum stored poses per second and pair, faster detections replace the newest pose
+POSE_HISTORY_MAX_AGE_SECONDS = 7.0  # edges not updated within this time (publish period + margin) do not set the reference time
+
+# frame scheduler: per frame deadline of the main loop and graceful degradation
+FRAME_BUDGET_SECONDS = 0.1          # deadline of one loop iteration
+FRAME_RISK_RATIO = 0.8              # frames above this share of the budget are at risk
+FRAME_RISK_FRAMES = 2               # frames at risk within the window to shed the next kind of work
+FRAME_RISK_WINDOW_SECONDS = 10.0    # sliding window for frames at risk, longer than the deferred solve interval
+FRAME_RECOVER_RATIO = 0.5           # frames below this share of the budget count towards recovery
+FRAME_RECOVER_FRAMES = 20           # consecutive fast frames (and no frame at risk in the window) to restore one level
+DEGRADED_DETECTION_SCALE = 0.5      # detection resolution at level 'low resolution'
+ROI_MARGIN = 1.5                    # region of interest radius in cube sizes around the last detections
+ROI_FULL_FRAME_EVERY = 10           # full frame detection every n detection runs at level 'roi detection'
+DEFERRED_SOLVE_SECONDS = 5.0        # solve interval at level 'defer solve'
+
+# state journal: crash safe persistence of marker_positions for a warm start
+JOURNAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state_journal.jsonl')
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state_snapshot.json')
+JOURNAL_SNAPSHOT_SECONDS = 30.0     # compaction interval of the journal into the snapshot
+JOURNAL_FSYNC_SECONDS = 1.0         # maximum time entries stay unsynced
+JOURNAL_MAX_AGE_SECONDS = 60.0      # restored camera data older than this is dropped
 
 # visualisation
 WINDOWSIZE = 0.5
@@ -42,6 +128,14 @@ TOPIC_3 = "EZS/beschtegruppe/3"
 TOPIC_4 = "EZS/beschtegruppe/4"
 TOPIC_5 = "EZS/beschtegruppe/5"
 TOPIC_6 = "EZS/beschtegruppe/6"
+TOPIC_PREFIX = "EZS/beschtegruppe"
+
+# central solver service (solver_service.py), publishes retained messages
+TOPIC_GLOBAL_POSES = "EZS/beschtegruppe/global/poses"
+TOPIC_GLOBAL_STATE = "EZS/beschtegruppe/global/state"
+SOLVER_SERVICE_INTERVAL = 1.0       # seconds between two solves of the service
+SOLVER_SERVICE_TIMEOUT = 3 * SOLVER_SERVICE_INTERVAL   # older service poses are ignored, the edge node solves locally
+USE_SOLVER_SERVICE = False          # True: edge node skips its own solve and uses the poses of the service
 
 #BROKER = "test.mosquitto.org"
 #BROKER = "broker.hivemq.com"
@@ -0,0 +1,209 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Time indexed pose history for every (observer camera, detected marker) pair.
+marker_positions only keeps the latest pose, so the solver chains transforms that were observed
+seconds apart by different cameras. The history keeps the poses of the last POSE_HISTORY_SECONDS of every pair
+in preallocated NumPy ring buffers and interpolates the pose at any time (slerp for the rotation,
+linear for the translation), so all edges can be aligned to one reference time before composing them.
+"""
+
+import threading
+import numpy as np
+from datetime import datetime
+import params as params
+
+def rvec_to_quaternion(rvec):
+    """
+    Converts a rotation vector (axis-angle) to a unit quaternion [w, x, y, z].
+    """
+    rvec = np.asarray(rvec, dtype=np.float64)
+    angle = np.linalg.norm(rvec)
+    if angle < 1e-12:
+        return np.array([1.0, 0.0, 0.0, 0.0])
+    return np.concatenate(([np.cos(angle / 2)], np.sin(angle / 2) * rvec / angle))
+
+def quaternion_to_rvec(quaternion):
+    """
+    Converts a unit quaternion [w, x, y, z] to a rotation vector (axis-angle).
+    """
+    w, xyz = quaternion[0], quaternion[1:]
+    sin_half = np.linalg.norm(xyz)
+    if sin_half < 1e-12:
+        return np.zeros(3)
+    angle = 2 * np.arctan2(sin_half, w)
+    return angle * xyz / sin_half
+
+def slerp(q0, q1, alpha):
+    """
+    Spherical linear interpolation between two unit quaternions.
+    """
+    dot = np.dot(q0, q1)
+    # take the short way around
+    if dot < 0:
+        q1, dot = -q1, -dot
+    if dot > 0.9995:
+        q = q0 + alpha * (q1 - q0)
+        return q / np.linalg.norm(q)
+    theta = np.arccos(dot)
+    return (np.sin((1 - alpha) * theta) * q0 + np.sin(alpha * theta) * q1) / np.sin(theta)
+
+class PoseHistory():
+    """
+    Fixed size ring buffers of timestamped poses for every (observer, marker) pair.
+    All pairs share preallocated arrays, a pair is mapped to a row once when it is seen first.
+    Appending a pose writes into the arrays in place, lookups use a binary search over the ring.
+    The buffers are sized by time span: stored poses are at least 1 / rate apart (a faster pose replaces
+    the newest one), so every pair covers at least span_seconds independent of the detection rate.
+
+    Attributes:
+        capacity (int): Number of poses kept per pair.
+        min_interval (float): Minimum time between two stored poses in seconds.
+        slots (dict): (observer_id, detected_id): row in the arrays.
+        times (np.ndarray): Timestamps in seconds, shape (pairs, capacity).
+        quaternions (np.ndarray): Rotations as quaternions, shape (pairs, capacity, 4).
+        translations (np.ndarray): Translations, shape (pairs, capacity, 3).
+    Methods:
+        add(): Appends a pose of a pair.
+        add_camera_dict(): Appends all valid detections of a camera dict received via MQTT.
+        pose_at(): Returns the interpolated pose of a pair at a given time.
+        latest_time(): Returns the time of the newest pose of a pair.
+    """
+    def __init__(self, span_seconds=params.POSE_HISTORY_SECONDS, rate=params.POSE_HISTORY_RATE, pairs=32):
+        self.min_interval = 1.0 / rate
+        # every gap except the newest one is at least min_interval
+        capacity = int(np.ceil(span_seconds * rate)) + 2
+        self.capacity = capacity
+        self.slots = {}
+        self.times = np.zeros((pairs, capacity))
+        self.quaternions = np.zeros((pairs, capacity, 4))
+        self.translations = np.zeros((pairs, capacity, 3))
+        self.start = np.zeros(pairs, dtype=np.int64)
+        self.count = np.zeros(pairs, dtype=np.int64)
+        self.lock = threading.Lock()
+
+    def get_slot(self, observer_id, detected_id):
+        key = (int(observer_id), int(detected_id))
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = len(self.slots)
+            if slot == len(self.times):
+                # more pairs than rows: double the arrays, happens only a few times
+                self.times = np.concatenate((self.times, np.zeros_like(self.times)))
+                self.quaternions = np.concatenate((self.quaternions, np.zeros_like(self.quaternions)))
+                self.translations = np.concatenate((self.translations, np.zeros_like(self.translations)))
+                self.start = np.concatenate((self.start, np.zeros_like(self.start)))
+                self.count = np.concatenate((self.count, np.zeros_like(self.count)))
+            self.slots[key] = slot
+        return slot
+
+    def add(self, observer_id, detected_id, timestamp, rvec, tvec):
+        """
+        Appends a pose. Poses older than the newest pose of the pair are ignored,
+        a pose less than min_interval after the second newest pose replaces the newest pose.
+        Args:
+            observer_id (int): ID of the camera which detected the marker.
+            detected_id (int): ID of the detected marker.
+            timestamp (float): Time of the detection in seconds (datetime.timestamp()).
+            rvec (list): Rotation vector.
+            tvec (list): Translation vector.
+        Returns:
+            added (bool): False if the pose was older than the newest pose of the pair.
+        """
+        with self.lock:
+            slot = self.get_slot(observer_id, detected_id)
+            count = self.count[slot]
+            newest = (self.start[slot] + count - 1) % self.capacity
+            if count and timestamp < self.times[slot, newest]:
+                return False
+
+            previous = (newest - 1) % self.capacity
+            if count and timestamp == self.times[slot, newest]:
+                # same detection time, overwrite the newest pose
+                index = newest
+            elif count >= 2 and self.times[slot, newest] - self.times[slot, previous] < self.min_interval:
+                # newest pose is closer than min_interval to its predecessor, replace it by the more recent one
+                index = newest
+            elif count == self.capacity:
+                # buffer full, overwrite the oldest pose
+                index = self.start[slot]
+                self.start[slot] = (self.start[slot] + 1) % self.capacity
+            else:
+                index = (self.start[slot] + count) % self.capacity
+                self.count[slot] += 1
+
+            self.times[slot, index] = timestamp
+            self.quaternions[slot, index] = rvec_to_quaternion(rvec)
+            self.translations[slot, index] = tvec
+            return True
+
+    def add_camera_dict(self, camera_dict):
+        """
+        Appends all valid detections of a camera dict (format of get_camera_dict).
+        Every detection is stored with its own 'timestamp' (time of the frame it was detected in),
+        peers without it fall back to the 'time' of the dict, which is the time of their newest detection.
+        Args:
+            camera_dict (dict): Camera dict with 'id', 'Others' and 'time'.
+        """
+        dict_timestamp = datetime.strptime(camera_dict['time'], "%Y-%m-%d %H:%M:%S").timestamp()
+        for other in camera_dict.get('Others', []):
+            try:
+                detected_id = int(other['detected_id'])
+                rvec = other['Position'][0]['rvecs']
+                tvec = other['Position'][1]['tvecs']
+                timestamp = float(other.get('timestamp', dict_timestamp))
+                if len(rvec) == 3 and len(tvec) == 3:
+                    self.add(camera_dict['id'], detected_id, timestamp, rvec, tvec)
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue
+
+    def latest_time(self, observer_id, detected_id):
+        """
+        Returns the time of the newest pose of the pair or None if the pair is unknown.
+        """
+        with self.lock:
+            slot = self.slots.get((int(observer_id), int(detected_id)))
+            if slot is None or not self.count[slot]:
+                return None
+            return float(self.times[slot, (self.start[slot] + self.count[slot] - 1) % self.capacity])
+
+    def pose_at(self, observer_id, detected_id, timestamp):
+        """
+        Returns the pose of a pair at the given time.
+        Between two stored poses the rotation is interpolated with slerp and the translation linearly,
+        outside of the stored time range the latest pose is returned.
+        Args:
+            observer_id (int): ID of the camera which detected the marker.
+            detected_id (int): ID of the detected marker.
+            timestamp (float): Time in seconds.
+        Returns:
+            tuple (rvec (list), tvec (list)) or (None, None) if the pair is unknown.
+        """
+        with self.lock:
+            slot = self.slots.get((int(observer_id), int(detected_id)))
+            if slot is None or not self.count[slot]:
+                return None, None
+            start, count, capacity = self.start[slot], self.count[slot], self.capacity
+            times = self.times[slot]
+
+            # binary search for the first pose newer than timestamp, in ring order
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if times[(start + middle) % capacity] <= timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+
+            if low == 0 or low == count:
+                index = (start + count - 1) % capacity
+                return quaternion_to_rvec(self.quaternions[slot, index]).tolist(), self.translations[slot, index].tolist()
+
+            before, after = (start + low - 1) % capacity, (start + low) % capacity
+            alpha = (timestamp - times[before]) / (times[after] - times[before])
+            quaternion = slerp(self.quaternions[slot, before], self.quaternions[slot, after], alpha)
+            translation = (1 - alpha) * self.translations[slot, before] + alpha * self.translations[slot, after]
+            return quaternion_to_rvec(quaternion).tolist(), translation.tolist()
@@ -0,0 +1,88 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Headless solver service (aggregator mode).
+Subscribes to the topics of all cameras, merges their detections like main.py and runs process_positions
+once per second for the whole fleet. The results are published as retained MQTT messages:
+- params.TOPIC_GLOBAL_POSES: solved global camera poses (rows of the DataFrame of process_positions)
+- params.TOPIC_GLOBAL_STATE: merged marker_positions of all cameras
+
+Edge nodes with params.USE_SOLVER_SERVICE = True skip their own solve and receive the retained messages
+immediately after subscribing, so a newly joined node is warm without waiting for the 5 second publishes.
+If a solve fails, or the service goes offline (last will), the retained poses are cleared. Edge nodes also
+ignore poses older than params.SOLVER_SERVICE_TIMEOUT and fall back to their own solve.
+
+Usage:
+    python solver_service.py
+"""
+
+import json
+import time
+import threading
+from datetime import datetime
+
+import params as params
+import paho.mqtt.client as mqtt
+from utils import handle_camera_message
+from pose_history import PoseHistory
+from process_positions import process_positions
+
+state_lock = threading.Lock()
+pose_history = PoseHistory()
+marker_positions = []
+
+def on_message(client, userdata, msg):
+    """
+    Callback function for MQTT messages of the cameras.
+    Unknown cameras are added to marker_positions, so the service works for any fleet size.
+    """
+    try:
+        new_data = json.loads(msg.payload.decode())
+        camera_id = int(str(msg.topic).rsplit('/', 1)[-1])
+        with state_lock:
+            if not any(camera_dict['id'] == camera_id for camera_dict in marker_positions):
+                marker_positions.append({'id': camera_id, 'Others': [], 'time': ""})
+            handle_camera_message(marker_positions, camera_id, new_data, pose_history)
+    except Exception as e:
+        print(f"Error processing message: {e}")
+
+def main():
+    client = mqtt.Client()
+    client.on_message = on_message
+    # an empty retained message clears the poses if the service disconnects without cleaning up
+    client.will_set(params.TOPIC_GLOBAL_POSES, payload=None, qos=1, retain=True)
+    client.connect(params.BROKER, params.PORT, 60)
+    client.subscribe(f"{params.TOPIC_PREFIX}/+", 1)
+    client.loop_start()
+    print(f"Solver service running, publishing to {params.TOPIC_GLOBAL_POSES} and {params.TOPIC_GLOBAL_STATE}")
+
+    solve_times = []
+    while True:
+        time.sleep(params.SOLVER_SERVICE_INTERVAL)
+        with state_lock:
+            snapshot = json.loads(json.dumps(marker_positions))
+
+        # CPU time of this thread only, the paho network thread is not part of the solve
+        start = time.thread_time()
+        global_camera_poses_positions = process_positions(snapshot, pose_history)
+        solve_times.append(time.thread_time() - start)
+
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        client.publish(params.TOPIC_GLOBAL_STATE, json.dumps({'time': now, 'cameras': snapshot}), qos=1, retain=True)
+        if global_camera_poses_positions is not None:
+            poses = {'time': now, 'cameras': global_camera_poses_positions.to_dict('records')}
+            client.publish(params.TOPIC_GLOBAL_POSES, json.dumps(poses, default=float), qos=1, retain=True)
+        else:
+            # no valid solve (e.g. anchor lost), clear the retained poses so no node starts on stale data
+            client.publish(params.TOPIC_GLOBAL_POSES, payload=None, qos=1, retain=True)
+
+        # CPU time of one solve is what every edge node saves per second
+        if len(solve_times) % 10 == 0:
+            mean_ms = 1000 * sum(solve_times[-10:]) / 10
+            print(f"{len(snapshot)} cameras, solve CPU time {mean_ms:.2f} ms per solve, saved on every edge node")
+
+if __name__ == "__main__":
+    main()
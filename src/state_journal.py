@@ -0,0 +1,190 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Crash safe persistence of marker_positions with an append-only journal.
+Rewriting marker_positions_rvecs_tvecs.json on every update is too slow for the MQTT callback,
+so it only puts the received camera dicts into a queue. A background thread appends them as JSON lines
+to the journal and periodically compacts the state into a snapshot (written to a temporary file
+and atomically renamed), after which the journal starts over.
+On startup the snapshot is loaded and the journal is replayed, so the solver has data immediately.
+Own detections are not journaled, they are detected again within the first frames after a restart.
+
+Journal entries (one JSON object per line):
+    {"op": "cam", "c": camera_id, "o": Others, "time": "..."}
+Entries are idempotent, so entries that are already contained in the snapshot can be replayed again.
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+import params as params
+
+def apply_entry(marker_positions, entry):
+    """
+    Applies one journal entry to marker_positions.
+    Args:
+        marker_positions (list): List of camera dicts.
+        entry (dict): Journal entry.
+    """
+    for camera_dict in marker_positions:
+        if camera_dict['id'] == entry['c']:
+            break
+    else:
+        camera_dict = {'id': entry['c'], 'Others': [], 'time': ""}
+        marker_positions.append(camera_dict)
+
+    if entry['op'] == 'cam':
+        camera_dict['Others'] = entry['o']
+        camera_dict['time'] = entry['time']
+
+class StateJournal():
+    """
+    Append-only journal of marker_positions with periodic snapshot compaction, written by a background thread.
+
+    Attributes:
+        journal_path (str): Path of the journal (JSON lines).
+        snapshot_path (str): Path of the snapshot (JSON, format of marker_positions).
+        state (list): Copy of marker_positions owned by the writer thread, used for the snapshots.
+    Methods:
+        load(): Loads the snapshot, replays the journal and starts the writer thread.
+        record_camera(): Queues a camera dict received via MQTT.
+        stop(): Writes the remaining entries and a final snapshot.
+    """
+    def __init__(self, journal_path=params.JOURNAL_PATH, snapshot_path=params.SNAPSHOT_PATH,
+                 snapshot_seconds=params.JOURNAL_SNAPSHOT_SECONDS, fsync_seconds=params.JOURNAL_FSYNC_SECONDS):
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self.snapshot_seconds = snapshot_seconds
+        self.fsync_seconds = fsync_seconds
+        self.entries = queue.Queue()
+        self.state = []
+        self.thread = None
+
+    def load(self, marker_positions, max_age_seconds=params.JOURNAL_MAX_AGE_SECONDS):
+        """
+        Loads the persisted state into marker_positions and starts the writer thread.
+        Camera dicts older than max_age_seconds are dropped. A torn last line of the journal (crash during a write)
+        is cut off before the writer appends to the journal again.
+        Args:
+            marker_positions (list): Initial marker_positions, updated in place.
+            max_age_seconds (float): Maximum age of restored camera dicts.
+        Returns:
+            marker_positions (list): marker_positions with the restored state.
+        """
+        state = json.loads(json.dumps(marker_positions))
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as file:
+                    state = json.load(file)
+            except (OSError, ValueError) as e:
+                print(f"Error loading snapshot: {e}")
+
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r+b') as file:
+                valid_length = 0
+                for line in file:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("incomplete line")
+                        apply_entry(state, json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # torn last line after a crash, cut it off so the next entry starts on a new line
+                        print(f"Journal: dropping torn entry at byte {valid_length}")
+                        file.truncate(valid_length)
+                        break
+                    valid_length += len(line)
+                    replayed += 1
+
+        now = datetime.now()
+        for restored in state:
+            # own detections are never journaled, an own entry of an older snapshot is not restored
+            if restored['id'] == params.CAMERA_ID or not restored.get('time'):
+                continue
+            age = (now - datetime.strptime(restored['time'], "%Y-%m-%d %H:%M:%S")).total_seconds()
+            if age > max_age_seconds:
+                continue
+            for camera_dict in marker_positions:
+                if camera_dict['id'] == restored['id']:
+                    camera_dict['Others'] = restored['Others']
+                    camera_dict['time'] = restored['time']
+                    break
+        print(f"Journal: restored state from snapshot and {replayed} journal entries")
+
+        self.state = json.loads(json.dumps(marker_positions))
+        self.thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        return marker_positions
+
+    def record_camera(self, camera_id, camera_dict):
+        self.entries.put({'op': 'cam', 'c': camera_id, 'o': camera_dict.get('Others', []), 'time': camera_dict.get('time', "")})
+
+    def write_snapshot(self, journal):
+        """
+        Writes the state atomically to the snapshot file and starts a new, empty journal.
+        """
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        # the snapshot contains every entry of the journal, it can be truncated now
+        journal.seek(0)
+        journal.truncate()
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def writer_loop(self):
+        last_fsync = time.monotonic()
+        last_snapshot = time.monotonic()
+        unsynced = False
+        with open(self.journal_path, 'a') as journal:
+            while True:
+                # wait for the first entry, then write everything that is queued in one go
+                batch = []
+                try:
+                    batch.append(self.entries.get(timeout=self.fsync_seconds))
+                except queue.Empty:
+                    pass
+                while True:
+                    try:
+                        batch.append(self.entries.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                for entry in batch:
+                    if entry is None:
+                        continue
+                    apply_entry(self.state, entry)
+                    journal.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                    unsynced = True
+
+                now = time.monotonic()
+                if stop or now - last_snapshot > self.snapshot_seconds:
+                    self.write_snapshot(journal)
+                    last_snapshot = last_fsync = now
+                    unsynced = False
+                elif unsynced and now - last_fsync >= self.fsync_seconds:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                    last_fsync = now
+                    unsynced = False
+                if stop:
+                    break
+
+    def stop(self):
+        """
+        Writes the remaining entries and a final snapshot, then stops the writer thread.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.entries.put(None)
+            self.thread.join()
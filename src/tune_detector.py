@@ -0,0 +1,297 @@
+"""
+Authors: Linus Wasner, Lukas Bauer
+Date: 2025-06-20
+Project: 3dimensionalArucoMarkerDetection
+Lekture: Echtzeitsysteme, Masterprogram advanced driver assistance systems, University of Applied Sciences Kempten
+
+Tuning harness for the ArUco detector parameters and the marker dictionary.
+Runs a parameter sweep over recorded frames (image folder or video file) and/or synthetic frames
+and measures detection latency, recall and pose error for every configuration.
+The best trade-off on the Pareto front is written to detector_profile.json, which is loaded by params.py at runtime.
+
+Sweep:
+- adaptive threshold window (min, max, step)
+- candidate perimeter range (minMarkerPerimeterRate, maxMarkerPerimeterRate)
+- corner refinement method
+- full DICT_6X6_250 or a reduced dictionary with only the IDs used in the project
+
+Ground truth:
+- synthetic frames: rendered with a known pose, so recall and pose error are absolute
+- recorded frames: the default detector (full dictionary, default parameters) is used as reference
+
+Usage:
+    python tune_detector.py --synthetic 200
+    python tune_detector.py --images ../recordings --synthetic 100 --output detector_profile.json
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+import params as params
+from utils import get_aruco_markers
+
+# IDs used in the project: reference cube 0-3 and camera cubes N0-N3
+PROJECT_MARKER_IDS = sorted(params.ANCHOR_MARKER_IDS | set(params.MARKER_TO_CAMERA.keys()))
+
+# frame size of the ESP32 stream (QVGA, matches the calibration)
+FRAME_WIDTH, FRAME_HEIGHT = 320, 240
+
+# sweep grid
+ADAPTIVE_THRESH_WINDOWS = [(3, 23, 10), (3, 13, 5), (5, 21, 8), (7, 31, 12)]
+PERIMETER_RATES = [(0.01, 4.0), (0.03, 4.0), (0.05, 2.0)]
+CORNER_REFINEMENTS = [aruco.CORNER_REFINE_NONE, aruco.CORNER_REFINE_SUBPIX, aruco.CORNER_REFINE_CONTOUR]
+REDUCED_DICTIONARY = [False, True]
+
+# profiles within this recall distance to the best recall and within this relative translation error
+# to the most accurate of them are considered equivalent, the fastest one wins
+# the absolute floor matters for recorded frames: the default configuration is the reference there and has 0 mm error
+RECALL_TOLERANCE = 0.01
+POSE_ERROR_TOLERANCE = 0.25
+POSE_ERROR_FLOOR_MM = 0.5
+
+def render_synthetic_frame(rng, max_markers=3):
+    """
+    Renders a frame with randomly placed markers and known poses.
+    Args:
+        rng (np.random.Generator): Random number generator.
+        max_markers (int): Maximum number of markers in the frame.
+    Returns:
+        frame (numpy.ndarray): Grayscale frame.
+        truth (dict): detected_id: (rvec, tvec) of the rendered markers.
+    """
+    # background with gradient and noise
+    gradient = np.linspace(rng.uniform(60, 140), rng.uniform(100, 200), FRAME_WIDTH)
+    frame = np.tile(gradient, (FRAME_HEIGHT, 1))
+    frame += rng.normal(0, 6, frame.shape)
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+
+    dictionary = aruco.getPredefinedDictionary(aruco.DICT_6X6_250)
+    marker_pixels = 120
+    half = params.MARKERLENGTH / 2
+    quiet = half * 1.4
+    source = np.array([[0, 0], [marker_pixels, 0], [marker_pixels, marker_pixels], [0, marker_pixels]], dtype=np.float32)
+
+    truth = {}
+    for detected_id in rng.choice(PROJECT_MARKER_IDS, size=rng.integers(1, max_markers + 1), replace=False):
+        # marker facing the camera (rotation of pi around x) with a random tilt
+        tilt = rng.uniform(-0.8, 0.8, 3) * np.array([1.0, 1.0, 3.0])
+        R_tilt, _ = cv2.Rodrigues(tilt)
+        R, _ = cv2.Rodrigues(np.array([np.pi, 0.0, 0.0]))
+        rvec, _ = cv2.Rodrigues(R_tilt @ R)
+        z = rng.uniform(0.08, 0.5)
+        tvec = np.array([rng.uniform(-0.3, 0.3) * z, rng.uniform(-0.2, 0.2) * z, z])
+
+        image_points = {}
+        for name, size in (('quiet', quiet), ('marker', half)):
+            object_points = np.array([[-size, size, 0], [size, size, 0], [size, -size, 0], [-size, -size, 0]], dtype=np.float64)
+            projected, _ = cv2.projectPoints(object_points, rvec, tvec, params.CAMERA_MATRIX, params.DISTCOEFFS)
+            image_points[name] = projected.reshape(4, 2).astype(np.float32)
+
+        # skip markers that leave the frame
+        if np.any(image_points['quiet'] < 0) or np.any(image_points['quiet'][:, 0] >= FRAME_WIDTH) or np.any(image_points['quiet'][:, 1] >= FRAME_HEIGHT):
+            continue
+
+        marker_image = aruco.generateImageMarker(dictionary, int(detected_id), marker_pixels)
+        for name, image in (('quiet', np.full_like(marker_image, 255)), ('marker', marker_image)):
+            H = cv2.getPerspectiveTransform(source, image_points[name])
+            warped = cv2.warpPerspective(image, H, (FRAME_WIDTH, FRAME_HEIGHT))
+            mask = cv2.warpPerspective(np.full_like(image, 255), H, (FRAME_WIDTH, FRAME_HEIGHT))
+            frame[mask > 0] = warped[mask > 0]
+        truth[int(detected_id)] = (rvec.reshape(3), tvec)
+
+    frame = cv2.GaussianBlur(frame, (3, 3), rng.uniform(0.1, 1.0))
+    return frame, truth
+
+def load_recorded_frames(path):
+    """
+    Loads recorded frames from an image folder or a video file.
+    Args:
+        path (str): Folder with images or path to a video file.
+    Returns:
+        frames (list): List of frames (numpy.ndarray).
+    """
+    frames = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            frame = cv2.imread(os.path.join(path, name))
+            if frame is not None:
+                frames.append(frame)
+    else:
+        cap = cv2.VideoCapture(path)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    return frames
+
+def build_configurations():
+    """
+    Builds all configurations of the sweep grid.
+    Returns:
+        configurations (list): List of profile dicts in the format of detector_profile.json.
+    """
+    configurations = []
+    for window, perimeter, refinement, reduced in itertools.product(ADAPTIVE_THRESH_WINDOWS, PERIMETER_RATES, CORNER_REFINEMENTS, REDUCED_DICTIONARY):
+        configurations.append({
+            'dictionary': 'DICT_6X6_250',
+            'marker_ids': PROJECT_MARKER_IDS if reduced else None,
+            'parameters': {
+                'adaptiveThreshWinSizeMin': window[0],
+                'adaptiveThreshWinSizeMax': window[1],
+                'adaptiveThreshWinSizeStep': window[2],
+                'minMarkerPerimeterRate': perimeter[0],
+                'maxMarkerPerimeterRate': perimeter[1],
+                'cornerRefinementMethod': refinement
+            }
+        })
+    return configurations
+
+def pose_error(rvec, tvec, rvec_truth, tvec_truth):
+    """
+    Computes translation and rotation error of an estimated pose.
+    Args:
+        rvec, tvec: Estimated pose.
+        rvec_truth, tvec_truth: Reference pose.
+    Returns:
+        tuple (translation_error (float) in m, rotation_error (float) in degrees)
+    """
+    R, _ = cv2.Rodrigues(np.array(rvec, dtype=np.float64))
+    R_truth, _ = cv2.Rodrigues(np.array(rvec_truth, dtype=np.float64))
+    cos_angle = np.clip((np.trace(R.T @ R_truth) - 1) / 2, -1.0, 1.0)
+    translation_error = np.linalg.norm(np.array(tvec) - np.array(tvec_truth))
+    return translation_error, np.degrees(np.arccos(cos_angle))
+
+def evaluate_configuration(configuration, samples):
+    """
+    Runs one configuration over all samples.
+    Args:
+        configuration (dict): Profile dict.
+        samples (list): List of (frame, truth) tuples.
+    Returns:
+        metrics (dict): latency_ms, recall, translation_error_mm, rotation_error_deg, false_positives
+    """
+    dictionary, detector_parameters, marker_ids = params.build_detector_setup(configuration)
+    latencies, translation_errors, rotation_errors = [], [], []
+    expected, found, false_positives = 0, 0, 0
+
+    for frame, truth in samples:
+        start = time.perf_counter()
+        ids, rvecs, tvecs, _ = get_aruco_markers(frame, dictionary, detector_parameters, marker_ids, cube_poses=False)
+        latencies.append(time.perf_counter() - start)
+
+        expected += len(truth)
+        for detected_id, rvec, tvec in zip(ids, rvecs, tvecs):
+            if int(detected_id) not in truth:
+                false_positives += 1
+                continue
+            found += 1
+            translation_error, rotation_error = pose_error(rvec, tvec, *truth[int(detected_id)])
+            translation_errors.append(translation_error)
+            rotation_errors.append(rotation_error)
+
+    return {
+        'latency_ms': 1000 * float(np.mean(latencies)),
+        'recall': found / expected if expected else 0.0,
+        'translation_error_mm': 1000 * float(np.mean(translation_errors)) if translation_errors else float('inf'),
+        'rotation_error_deg': float(np.mean(rotation_errors)) if rotation_errors else float('inf'),
+        'false_positives': false_positives
+    }
+
+def find_pareto_front(results):
+    """
+    Returns the configurations that are not dominated in latency, recall and translation error.
+    Args:
+        results (list): List of (configuration, metrics) tuples.
+    Returns:
+        pareto (list): Non-dominated (configuration, metrics) tuples.
+    """
+    def dominates(a, b):
+        not_worse = a['latency_ms'] <= b['latency_ms'] and a['recall'] >= b['recall'] and a['translation_error_mm'] <= b['translation_error_mm']
+        better = a['latency_ms'] < b['latency_ms'] or a['recall'] > b['recall'] or a['translation_error_mm'] < b['translation_error_mm']
+        return not_worse and better
+
+    return [(c, m) for c, m in results if not any(dominates(other, m) for _, other in results)]
+
+def select_profile(pareto):
+    """
+    Selects the fastest Pareto configuration whose recall is within RECALL_TOLERANCE of the best recall
+    and whose translation error is within POSE_ERROR_TOLERANCE (at least POSE_ERROR_FLOOR_MM) of the most accurate
+    of these configurations.
+    Ties are broken by the translation error.
+    Args:
+        pareto (list): Non-dominated (configuration, metrics) tuples.
+    Returns:
+        tuple (configuration, metrics, reason (str))
+    """
+    best_recall = max(m['recall'] for _, m in pareto)
+    candidates = [(c, m) for c, m in pareto if m['recall'] >= best_recall - RECALL_TOLERANCE]
+    best_error = min(m['translation_error_mm'] for _, m in candidates)
+    max_error = max(best_error * (1 + POSE_ERROR_TOLERANCE), best_error + POSE_ERROR_FLOOR_MM)
+    accurate = [(c, m) for c, m in candidates if m['translation_error_mm'] <= max_error]
+    configuration, metrics = min(accurate, key=lambda cm: (cm[1]['latency_ms'], cm[1]['translation_error_mm']))
+
+    reason = (f"fastest of {len(accurate)} configurations with recall >= {best_recall - RECALL_TOLERANCE:.3f} "
+              f"(best {best_recall:.3f}) and translation error <= {max_error:.2f} mm (best {best_error:.2f} mm)")
+    rejected = [m for c, m in candidates if m['translation_error_mm'] > max_error and m['latency_ms'] < metrics['latency_ms']]
+    if rejected:
+        fastest = min(rejected, key=lambda m: m['latency_ms'])
+        reason += (f", faster {fastest['latency_ms']:.2f} ms configuration rejected because of "
+                   f"{fastest['translation_error_mm']:.2f} mm translation error")
+    return configuration, metrics, reason
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep ArUco detector parameters and write the best profile.")
+    parser.add_argument('--images', help="folder with recorded frames or a video file")
+    parser.add_argument('--synthetic', type=int, default=0, help="number of synthetic frames")
+    parser.add_argument('--seed', type=int, default=0, help="seed for the synthetic frames")
+    parser.add_argument('--output', default=params.DETECTOR_PROFILE_PATH, help="path of the profile JSON file")
+    args = parser.parse_args()
+
+    samples = []
+    if args.images:
+        # reference detections of the default detector as ground truth for recorded frames
+        reference = params.build_detector_setup({'dictionary': 'DICT_6X6_250', 'marker_ids': None, 'parameters': {}})
+        for frame in load_recorded_frames(args.images):
+            ids, rvecs, tvecs, _ = get_aruco_markers(frame, *reference, cube_poses=False)
+            truth = {int(i): (r, t) for i, r, t in zip(ids, rvecs, tvecs) if int(i) in PROJECT_MARKER_IDS}
+            samples.append((frame, truth))
+    rng = np.random.default_rng(args.seed)
+    for _ in range(args.synthetic):
+        samples.append(render_synthetic_frame(rng))
+
+    if not samples:
+        print("Error: no frames, use --images and/or --synthetic")
+        exit(1)
+
+    configurations = build_configurations()
+    print(f"Evaluating {len(configurations)} configurations on {len(samples)} frames")
+    results = []
+    for configuration in configurations:
+        metrics = evaluate_configuration(configuration, samples)
+        results.append((configuration, metrics))
+        print(f"{json.dumps(configuration['parameters'])} reduced={configuration['marker_ids'] is not None}: "
+              f"{metrics['latency_ms']:.2f} ms, recall {metrics['recall']:.3f}, "
+              f"{metrics['translation_error_mm']:.2f} mm, {metrics['rotation_error_deg']:.2f} deg, fp {metrics['false_positives']}")
+
+    pareto = find_pareto_front(results)
+    print(f"\nPareto front ({len(pareto)} configurations):")
+    for configuration, metrics in sorted(pareto, key=lambda cm: cm[1]['latency_ms']):
+        print(f"  {metrics['latency_ms']:.2f} ms, recall {metrics['recall']:.3f}, {metrics['translation_error_mm']:.2f} mm: {json.dumps(configuration)}")
+
+    configuration, metrics, reason = select_profile(pareto)
+    print(f"\nSelected {metrics['latency_ms']:.2f} ms, recall {metrics['recall']:.3f}, {metrics['translation_error_mm']:.2f} mm: {reason}")
+    profile = dict(configuration, metrics=metrics)
+    with open(args.output, 'w') as f:
+        json.dump(profile, f, indent=4)
+    print(f"\nWrote profile to {args.output}: {json.dumps(profile)}")
+
+if __name__ == "__main__":
+    main()
@@ -23,14 +23,16 @@ class ArucoMarker():
         rvecs (list): Rotation vectors of the marker.
         tvecs (list): Translation vectors of the marker.
         timestamp (datetime): Timestamp when the marker was detected.
+        quality (float): Quality score of the detection between 0 and 1.
     Methods:
         delete_position(): Deletes the marker's position from the JSON file.
         update_position(): Updates the marker's position in the JSON file.
     """
-    def __init__(self, detected_id, rvecs, tvecs, timestamp):
+    def __init__(self, detected_id, rvecs, tvecs, timestamp, quality=1.0):
         self.detected_id = int(detected_id)
         self.rvecs = rvecs
         self.tvecs = tvecs
+        self.quality = quality
 
         self.timestamp = timestamp
         self.timestamp_mqtt = self.timestamp.strftime('%Y-%m-%d %H:%M:%S')
@@ -65,7 +67,7 @@ class ArucoMarker():
                         camera_dict['Others'].remove(other)
                         return marker_positions
                     
-    def update_position(self, marker_positions, timestamp, rvecs=None, tvecs=None):
+    def update_position(self, marker_positions, timestamp, rvecs=None, tvecs=None, quality=None):
         """
         Updates the position of the marker in marker_positions.json.
         """
@@ -77,6 +79,8 @@ class ArucoMarker():
 
         self.rvecs = rvecs
         self.tvecs = tvecs
+        if quality is not None:
+            self.quality = quality
         self.timestamp = timestamp
         self.timestamp_mqtt = self.timestamp.strftime('%Y-%m-%d %H:%M:%S')
 
@@ -96,6 +100,8 @@ class ArucoMarker():
                 for other in camera_dict['Others']:                 
                     if other['detected_id'] == self.detected_id:
                         other['Position'] = [{'rvecs': self.rvecs}, {'tvecs': self.tvecs}]
+                        other['quality'] = self.quality
+                        other['timestamp'] = self.timestamp.timestamp()
                         camera_dict["time"] = str(self.timestamp_mqtt)
                         # with open('src/marker_positions_rvecs_tvecs.json', 'w') as f:
                         #     json.dump(marker_positions, f, indent=4)
@@ -106,35 +112,250 @@ class ArucoMarker():
                     'detected_id': self.detected_id,
                     'Position': [
                         {'rvecs': self.rvecs}, {'tvecs': self.tvecs}
-                    ]
+                    ],
+                    'quality': self.quality,
+                    'timestamp': self.timestamp.timestamp()
                 })
                 camera_dict["time"] = str(self.timestamp_mqtt)
                 # with open('src/marker_positions_rvecs_tvecs.json', 'w') as f:
                 #     json.dump(marker_positions, f, indent=4)
                 return marker_positions
 
-def get_aruco_markers(frame):
+class MotionGate():
+    """
+    Cheap change detector that decides whether a frame has to run through the marker detection.
+    The frame is converted to grayscale, downscaled and compared with the last frame that was detected.
+    The largest difference of a downscaled cell counts, not the mean over the frame, so a small marker that moves
+    in a static scene is still noticed.
+    A forced refresh interval makes sure static markers are re-detected before the 5 second expiry in main.py.
+
+    Attributes:
+        downscale (int): Factor by which the frame is shrunk before comparing.
+        threshold (float): Absolute gray value difference of one downscaled cell that counts as motion.
+        refresh_seconds (float): Maximum time between two detections.
+        frames (int): Number of frames checked.
+        skipped (int): Number of frames where the detection was skipped.
+        detection_seconds (float): Accumulated time spent in the detection.
+    Methods:
+        frame_changed(): Returns True if the detection has to run for this frame.
+        add_detection_time(): Adds the duration of one detection to the statistics.
+        get_stats(): Returns skip ratio and the estimated saved detection time.
+    """
+    def __init__(self, downscale=params.MOTION_DOWNSCALE, threshold=params.MOTION_THRESHOLD, refresh_seconds=params.MOTION_REFRESH_SECONDS):
+        self.downscale = downscale
+        self.threshold = threshold
+        self.refresh_seconds = refresh_seconds
+        self.reference = None
+        self.reference_time = None
+
+        self.frames = 0
+        self.skipped = 0
+        self.detected = 0
+        self.detection_seconds = 0.0
+
+    def frame_changed(self, frame, timestamp):
+        """
+        Compares the frame with the last detected frame.
+        Args:
+            frame (numpy.ndarray): The current frame.
+            timestamp (datetime): The timestamp when the frame was captured.
+        Returns:
+            changed (bool): True if the detection has to run, False if the last result can be reused.
+        """
+        self.frames += 1
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        small = cv2.resize(gray, (max(1, gray.shape[1] // self.downscale), max(1, gray.shape[0] // self.downscale)), interpolation=cv2.INTER_AREA)
+
+        if self.reference is not None and self.reference.shape == small.shape:
+            difference = cv2.absdiff(small, self.reference).max()
+            expired = (timestamp - self.reference_time).total_seconds() > self.refresh_seconds
+            if difference < self.threshold and not expired:
+                self.skipped += 1
+                return False
+
+        self.reference = small
+        self.reference_time = timestamp
+        return True
+
+    def add_detection_time(self, seconds):
+        """
+        Adds the duration of one detection to the statistics.
+        Args:
+            seconds (float): Duration of the detection in seconds.
+        """
+        self.detected += 1
+        self.detection_seconds += seconds
+
+    def get_stats(self):
+        """
+        Returns the statistics of the gate.
+        Returns:
+            stats (dict): frames, skipped, skip_ratio and saved_seconds (skipped frames times mean detection time).
+        """
+        mean_detection = self.detection_seconds / self.detected if self.detected else 0.0
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'skip_ratio': self.skipped / self.frames if self.frames else 0.0,
+            'saved_seconds': self.skipped * mean_detection
+        }
+
+def get_marker_object_points(marker_length=params.MARKERLENGTH):
+    """
+    Returns the corners of a marker in its own coordinate system, in the order of detectMarkers.
+    """
+    half = marker_length / 2
+    return np.array([[-half, half, 0], [half, half, 0], [half, -half, 0], [-half, -half, 0]], dtype=np.float64)
+
+def get_cube_face_points(face_id):
+    """
+    Returns the corners of marker face_id (0-3) in the coordinate system of its cube.
+    The orientation of the faces is given by params.ANCHOR_MARKER_WORLD_POSES (cube -> marker),
+    every marker sits params.CUBE_MARKER_OFFSET in front of the cube center.
+    Args:
+        face_id (int): Position of the marker on the cube (detected_id % 10).
+    Returns:
+        points (np.ndarray): 4x3 array of corner coordinates.
+    """
+    R = params.ANCHOR_MARKER_WORLD_POSES[face_id][:3, :3]
+    points = get_marker_object_points() + np.array([0.0, 0.0, params.CUBE_MARKER_OFFSET])
+    return points @ R
+
+def get_detection_quality(object_points, image_points, rvec, tvec, faces):
+    """
+    Computes the quality score of a pose estimate from reprojection error and viewing angle.
+    The pixel area is not part of the score, small (distant) markers with a clean pose are not dropped,
+    the solver prefers larger markers when it ranks the edges (see load_valid_marker_data).
+    Args:
+        object_points (np.ndarray): Nx3 corners in the coordinate system of the pose.
+        image_points (np.ndarray): Nx2 detected corners, 4 per marker face.
+        rvec, tvec: Estimated pose.
+        faces (list): Normals (3 elements) of the marker faces in the coordinate system of the pose.
+    Returns:
+        quality (float): Score between 0 (useless) and 1 (perfect).
+    """
+    projected, _ = cv2.projectPoints(object_points, rvec, tvec, params.CAMERA_MATRIX, params.DISTCOEFFS)
+    reprojection_error = np.sqrt(np.mean(np.sum((projected.reshape(-1, 2) - image_points) ** 2, axis=1)))
+
+    # viewing angle of the most frontal face: angle between face normal and the ray to the camera
+    R, _ = cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))
+    ray = np.asarray(tvec, dtype=np.float64).reshape(3)
+    ray = ray / np.linalg.norm(ray)
+    cos_angle = max(-np.dot(R @ np.asarray(normal), ray) for normal in faces)
+
+    quality = np.exp(-reprojection_error / params.QUALITY_REPROJECTION_SCALE)
+    quality *= max(0.0, cos_angle)
+    return float(quality)
+
+def estimate_cube_poses(corners, ids):
+    """
+    Estimates one pose per cube from all visible markers of the cube with a single PnP solve.
+    The pose is returned as the pose of marker N0 (cube*10), so the solver and the MQTT format stay unchanged,
+    but the position refers to the cube center instead of the marker face.
+    Args:
+        corners (list): Marker corners from detectMarkers.
+        ids (np.ndarray): Marker IDs.
+    Returns:
+        ids (list): IDs of the N0 markers of all detected cubes.
+        rvecs (list): List of lists with rotation vectors for each cube.
+        tvecs (list): List of lists with translation vectors for each cube.
+        qualities (list): Quality score of each cube pose.
+    """
+    cubes = {}
+    for marker_corners, detected_id in zip(corners, ids):
+        cubes.setdefault(int(detected_id) // 10, []).append((int(detected_id) % 10, marker_corners.reshape(4, 2)))
+
+    cube_ids, rvecs, tvecs, qualities = [], [], [], []
+    for cube_id, faces in cubes.items():
+        faces = [(face_id, image_points) for face_id, image_points in faces if face_id in params.ANCHOR_MARKER_WORLD_POSES]
+        if not faces:
+            continue
+        object_points = np.concatenate([get_cube_face_points(face_id) for face_id, _ in faces])
+        image_points = np.concatenate([image_points for _, image_points in faces]).astype(np.float64)
+
+        if len(faces) == 1:
+            # a single planar marker: IPPE like estimatePoseSingleMarkers, then move to the cube center
+            ok, rvec, tvec = cv2.solvePnP(get_marker_object_points(), image_points, params.CAMERA_MATRIX, params.DISTCOEFFS, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+            R_cam_marker, _ = cv2.Rodrigues(rvec)
+            R_marker_cube = params.ANCHOR_MARKER_WORLD_POSES[faces[0][0]][:3, :3]
+            R_cam_cube = R_cam_marker @ R_marker_cube
+            tvec = tvec.reshape(3) - R_cam_marker @ np.array([0.0, 0.0, params.CUBE_MARKER_OFFSET])
+            rvec, _ = cv2.Rodrigues(R_cam_cube)
+        else:
+            ok, rvec, tvec = cv2.solvePnP(object_points, image_points, params.CAMERA_MATRIX, params.DISTCOEFFS, flags=cv2.SOLVEPNP_SQPNP)
+        if not ok:
+            continue
+        normals = [params.ANCHOR_MARKER_WORLD_POSES[face_id][2, :3] for face_id, _ in faces]
+        quality = get_detection_quality(object_points, image_points, rvec, tvec, normals)
+
+        # cube -> camera, expressed as pose of marker N0 (the solver multiplies with ANCHOR_MARKER_WORLD_POSES[0])
+        R_cam_cube, _ = cv2.Rodrigues(rvec)
+        R_cam_marker0 = R_cam_cube @ params.ANCHOR_MARKER_WORLD_POSES[0][:3, :3].T
+        rvec, _ = cv2.Rodrigues(R_cam_marker0)
+        cube_ids.append(cube_id * 10)
+        rvecs.append(rvec.reshape(3).tolist())
+        tvecs.append(np.asarray(tvec).reshape(3).tolist())
+        qualities.append(quality)
+    return cube_ids, rvecs, tvecs, qualities
+
+def get_aruco_markers(frame, aruco_dict=None, parameters=None, marker_ids=None, cube_poses=None, detector=None, scale=1.0, roi=None):
     """
     Detects ArUco markers in the given frame.
     Returns a list of detected markers with their IDs, distances, and angles.
     Args:
         frame (numpy.ndarray): The image frame in which to detect markers.
+        aruco_dict (aruco.Dictionary, optional): Dictionary to use, default params.aruco_dict.
+        parameters (aruco.DetectorParameters, optional): Detector parameters, default params.parameters.
+        marker_ids (numpy.ndarray, optional): Marker IDs of a reduced dictionary, default params.ARUCO_MARKER_IDS.
+        cube_poses (bool, optional): One pose per cube instead of one per marker, default params.CUBE_POSE_ESTIMATION.
+        detector (aruco.ArucoDetector, optional): Existing detector, created from aruco_dict and parameters if None.
+        scale (float, optional): Detect on a frame resized by this factor, the corners are scaled back before the pose estimation.
+        roi (tuple, optional): (x0, y0, x1, y1) region of interest, detect only inside of it.
     Returns:
         ids (list): List of detected marker IDs.
         rvecs (list): List of lists with rotation vectors for each detected marker.
         tvecs (list): List of lists with translation vectors for each detected marker.
+        qualities (list): Quality score of each detection, see get_detection_quality().
     """
-    detector = aruco.ArucoDetector(params.aruco_dict, params.parameters)
-    corners, ids, _ = detector.detectMarkers(frame)
+    if aruco_dict is None:
+        aruco_dict, parameters, marker_ids = params.aruco_dict, params.parameters, params.ARUCO_MARKER_IDS
+    if cube_poses is None:
+        cube_poses = params.CUBE_POSE_ESTIMATION
+    if detector is None:
+        detector = aruco.ArucoDetector(aruco_dict, parameters)
+    image = frame
+    offset = np.zeros(2, dtype=np.float32)
+    scale_xy = np.ones(2, dtype=np.float32)
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        image = image[y0:y1, x0:x1]
+        offset = np.array([x0, y0], dtype=np.float32)
+    if scale != 1.0:
+        height, width = image.shape[:2]
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        # actual factor per axis, the resized size is rounded to whole pixels
+        scale_xy = np.array([image.shape[1] / width, image.shape[0] / height], dtype=np.float32)
+    corners, ids, _ = detector.detectMarkers(image)
     
     if ids is not None:
+        # corners back to full frame coordinates, the camera matrix belongs to the full frame
+        # pixel centers: pixel i of the resized image covers (i + 0.5) / scale - 0.5 of the original image
+        if roi is not None or scale != 1.0:
+            corners = tuple(((marker_corners + 0.5) / scale_xy - 0.5 + offset).astype(np.float32) for marker_corners in corners)
         ids = ids.flatten()
+        # a reduced dictionary numbers its markers from 0, map them back to the real marker IDs
+        if marker_ids is not None:
+            ids = marker_ids[ids]
+        if cube_poses:
+            return estimate_cube_poses(corners, ids)
         rvecs, tvecs, _ = aruco.estimatePoseSingleMarkers(corners, params.MARKERLENGTH, params.CAMERA_MATRIX, params.DISTCOEFFS)
+        qualities = [get_detection_quality(get_marker_object_points(), marker_corners.reshape(4, 2), rvec[0], tvec[0], [[0.0, 0.0, 1.0]])
+                     for marker_corners, rvec, tvec in zip(corners, rvecs, tvecs)]
         rvecs = [rvec[0].tolist() for rvec in rvecs]
         tvecs = [tvec[0].tolist() for tvec in tvecs]        
-        return ids, rvecs, tvecs
+        return ids, rvecs, tvecs, qualities
     else:	
-        return [], [], []
+        return [], [], [], []
     
 def get_camera_dict(camera_id, marker_positions):
     """
@@ -148,6 +369,53 @@ def get_camera_dict(camera_id, marker_positions):
         if camera_dict['id'] == camera_id:  
             return camera_dict
 
+def merge_camera_message(marker_positions, camera_id, new_data):
+    """
+    Merges a camera dict received via MQTT into marker_positions.
+    The data is only taken over if it is newer than the stored data of this camera.
+    Args:
+        marker_positions (list): List of camera dicts.
+        camera_id (int): ID of the camera which published the message.
+        new_data (dict): Received camera dict with 'Others' and 'time'.
+    Returns:
+        updated (bool): True if the stored data was replaced.
+    """
+    for camera_dict in marker_positions:
+        if camera_dict['id'] == camera_id:
+            if camera_dict["time"] == "":
+                camera_dict['Others'] = new_data.get('Others', camera_dict['Others'])
+                camera_dict['time'] = new_data.get('time', camera_dict['time'])
+                return True
+            old_time_stamp = datetime.strptime(camera_dict["time"], "%Y-%m-%d %H:%M:%S")
+            new_time_stamp = datetime.strptime(new_data["time"], "%Y-%m-%d %H:%M:%S")
+            if old_time_stamp < new_time_stamp:
+                camera_dict['Others'] = new_data.get('Others', camera_dict['Others'])
+                camera_dict['time'] = new_data.get('time', camera_dict['time'])
+                return True
+            return False
+    return False
+
+def handle_camera_message(marker_positions, camera_id, new_data, pose_history=None, state_journal=None):
+    """
+    Handles a camera dict received via MQTT, body of on_message in main.py.
+    Merges it into marker_positions and records accepted data in the pose history and the state journal.
+    Args:
+        marker_positions (list): List of camera dicts.
+        camera_id (int): ID of the camera which published the message.
+        new_data (dict): Received camera dict with 'Others' and 'time'.
+        pose_history (PoseHistory, optional): Pose history of all (camera, marker) pairs.
+        state_journal (StateJournal, optional): Journal for the warm start.
+    Returns:
+        updated (bool): True if the stored data was replaced.
+    """
+    updated = merge_camera_message(marker_positions, camera_id, new_data)
+    if updated:
+        if pose_history is not None:
+            pose_history.add_camera_dict(dict(new_data, id=camera_id))
+        if state_journal is not None:
+            state_journal.record_camera(camera_id, new_data)
+    return updated
+
 def get_frame(cap):
     """
     Captures a frame from the video stream.
@@ -169,18 +437,22 @@ def get_frame(cap):
 
     return frame, timestamp
 
-def get_marker_detections(frame, photo_timestamp):
+def get_marker_detections(frame, photo_timestamp, scale=1.0, roi=None):
     """
     Detects ArUco markers in the given frame
     Args:
         frame (numpy.ndarray): The image frame in which to detect markers.
         photo_timestamp (datetime): The timestamp when the photo was taken.
+        scale (float, optional): Detection resolution relative to the frame.
+        roi (tuple, optional): (x0, y0, x1, y1) region of interest, None for the full frame.
     Returns:
-        markers (list): List of ArucoMarker objects from class ArucoMarker."""
-    ids, rvecs, tvecs = get_aruco_markers(frame)
+        markers (list): List of ArucoMarker objects from class ArucoMarker, detections below params.QUALITY_THRESHOLD are dropped."""
+    ids, rvecs, tvecs, qualities = get_aruco_markers(frame, scale=scale, roi=roi)
     markers = []
-    for detected_id, rvec, tvec in zip(ids, rvecs, tvecs):
-        marker = ArucoMarker(detected_id, rvec, tvec, photo_timestamp)
+    for detected_id, rvec, tvec, quality in zip(ids, rvecs, tvecs, qualities):
+        if quality < params.QUALITY_THRESHOLD:
+            continue
+        marker = ArucoMarker(detected_id, rvec, tvec, photo_timestamp, quality)
         markers.append(marker)
     return markers
 